@@ -1,20 +1,185 @@
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import copy
+import hashlib
+import json
+import math
 import numpy
+import os
+import platform
 import random
-import pylab as pl
+import statistics
+import sys
+import time
+import tracemalloc
+import types
+
+class Genotype(object):
+    """
+    Immutable record of the heritable parameters shared by virus particles:
+    maxBirthProb, clearProb, the resistances and mutProb. Records are interned
+    (see get()), so all particles with equal parameters reference a single
+    instance and offspring that do not mutate reuse their parent's record.
+    The resistances are also kept as a bitmask over the tuple of drugs: bit i
+    is set when the genotype is resistant to drugs[i]. Genotypes with the same
+    drugs and mutProb share the tables used by blockMask() and mutate(), so
+    the cost of a birth barely depends on the number of drugs.
+    """
+    __slots__ = ('maxBirthProb', 'clearProb', 'drugs', 'mask', 'mutProb', 'resistances',
+                 'resistantDrugs', '_mutants', '_family')
+
+    _interned = {}
+    _families = {}
+
+    def __init__(self, maxBirthProb, clearProb, drugs, mask, mutProb):
+        """
+        Use Genotype.get() or withMask() instead, which return interned records.
+        """
+        self.maxBirthProb = maxBirthProb
+        self.clearProb = clearProb
+        self.drugs = drugs
+        self.mask = mask
+        self.mutProb = mutProb
+        resistances = dict((drug, bool(mask >> i & 1)) for i, drug in enumerate(drugs))
+        self.resistances = types.MappingProxyType(resistances)
+        self.resistantDrugs = frozenset(drug for drug in drugs if resistances[drug])
+        self._mutants = {}
+        self._family = Genotype._families.get((drugs, mutProb))
+        if self._family is None:
+            numDrugs = len(drugs)
+            mutationCdf = []
+            cumulative = 0.0
+            for flips in range(numDrugs + 1):
+                cumulative += math.comb(numDrugs, flips) * mutProb ** flips * (1 - mutProb) ** (numDrugs - flips)
+                mutationCdf.append(cumulative)
+            mutationCdf[-1] = 1.0
+            self._family = Genotype._families[(drugs, mutProb)] = {
+                'index': dict((drug, i) for i, drug in enumerate(drugs)),
+                'blockMasks': {},
+                'mutationCdf': mutationCdf,
+            }
+
+    @classmethod
+    def get(cls, maxBirthProb, clearProb, resistances, mutProb):
+        """
+        resistances: A dictionary of drug names (strings) mapping to the state
+        of resistance (True or False) to each drug.
+        returns: the interned Genotype with these parameters
+        """
+        drugs = tuple(resistances)
+        mask = 0
+        for i, drug in enumerate(drugs):
+            if resistances[drug]:
+                mask |= 1 << i
+        return cls._intern(maxBirthProb, clearProb, drugs, mask, mutProb)
+
+    @classmethod
+    def _intern(cls, maxBirthProb, clearProb, drugs, mask, mutProb):
+        key = (maxBirthProb, clearProb, drugs, mask, mutProb)
+        genotype = cls._interned.get(key)
+        if genotype is None:
+            genotype = cls._interned[key] = cls(maxBirthProb, clearProb, drugs, mask, mutProb)
+        return genotype
+
+    def withMask(self, mask):
+        """
+        returns: the interned Genotype that differs from this one only by its
+        resistance bitmask
+        """
+        genotype = self._mutants.get(mask)
+        if genotype is None:
+            genotype = self._mutants[mask] = self._intern(self.maxBirthProb, self.clearProb, self.drugs,
+                                                          mask, self.mutProb)
+        return genotype
+
+    def blockMask(self, activeDrugs):
+        """
+        Get the bitmask a genotype must cover to reproduce under activeDrugs. A
+        drug outside drugs maps to a bit no genotype has, since no particle is
+        resistant to it.
+        activeDrugs: a list of drug names (strings)
+        returns: the bitmask (an integer)
+        """
+        key = tuple(activeDrugs)
+        blockMasks = self._family['blockMasks']
+        mask = blockMasks.get(key)
+        if mask is None:
+            index = self._family['index']
+            mask = 0
+            for drug in key:
+                mask |= 1 << index.get(drug, len(self.drugs))
+            blockMasks[key] = mask
+        return mask
+
+    def mutate(self):
+        """
+        Draws the genotype of an offspring, each resistance trait switching
+        independently with probability mutProb. A single random number
+        decides how many traits switch (binomially distributed); only when
+        some do are the switched traits sampled.
+        returns: the interned Genotype of the offspring (this one if no trait
+        switches)
+        """
+        mutationCdf = self._family['mutationCdf']
+        u = random.random()
+        if u < mutationCdf[0]:
+            return self
+        mask = self.mask
+        for i in random.sample(range(len(self.drugs)), bisect.bisect_right(mutationCdf, u)):
+            mask ^= 1 << i
+        return self.withMask(mask)
+
+    def __reduce__(self):
+        return (Genotype._intern, (self.maxBirthProb, self.clearProb, self.drugs, self.mask, self.mutProb))
+
 
 class SimpleVirus(object):
     """
     Representation of a simple virus (does not model drug effects/resistance).
+    A particle only holds a reference to its interned Genotype, which
+    provides maxBirthProb and clearProb; assigning either of them swaps in
+    the Genotype with the new value.
     """
+    __slots__ = ('genotype',)
+
     def __init__(self, maxBirthProb, clearProb):
         """
-             Initialize a SimpleVirus instance, saves all parameters as attributes
-             of the instance.
+             Initialize a SimpleVirus instance, saves all parameters in the
+             interned Genotype the instance refers to.
              maxBirthProb: Maximum reproduction probability (a float between 0-1)
              clearProb: Maximum clearance probability (a float between 0-1).
         """
-        self.maxBirthProb=maxBirthProb
-        self.clearProb=clearProb
+        self.genotype=Genotype.get(maxBirthProb, clearProb, {}, 0)
+
+    @classmethod
+    def fromGenotype(cls, genotype):
+        """
+        returns: a new particle of the given Genotype, built without copying
+        or hashing its parameters
+        """
+        virus = cls.__new__(cls)
+        virus.genotype = genotype
+        return virus
+
+    @property
+    def maxBirthProb(self):
+        return self.genotype.maxBirthProb
+
+    @maxBirthProb.setter
+    def maxBirthProb(self, maxBirthProb):
+        genotype = self.genotype
+        self.genotype = Genotype.get(maxBirthProb, genotype.clearProb, genotype.resistances, genotype.mutProb)
+
+    @property
+    def clearProb(self):
+        return self.genotype.clearProb
+
+    @clearProb.setter
+    def clearProb(self, clearProb):
+        genotype = self.genotype
+        self.genotype = Genotype.get(genotype.maxBirthProb, clearProb, genotype.resistances, genotype.mutProb)
 
 
     def doesClear(self):
@@ -25,7 +190,7 @@ class SimpleVirus(object):
              returns True with probability self.clearProb and otherwise returns
              False.
         """
-        if random.random() <= self.clearProb:
+        if random.random() <= self.genotype.clearProb:
             return True
         else:
             return False
@@ -49,8 +214,8 @@ class SimpleVirus(object):
              maxBirthProb and clearProb values as this virus. Raises a
              NoChildException if this virus particle does not reproduce.
         """
-        if random.random() <= self.maxBirthProb * (1 - popDensity):
-            return SimpleVirus(self.maxBirthProb, self.clearProb)
+        if random.random() <= self.genotype.maxBirthProb * (1 - popDensity):
+            return SimpleVirus.fromGenotype(self.genotype)
         else:
             raise NoChildException()
 
@@ -88,26 +253,57 @@ class SimplePatient(object):
 
         - Determine whether each virus particle should reproduce and add
         offspring virus particles to the list of viruses in this patient.
+        Only the particles that survived reproduce: offspring born during the
+        update do not reproduce before the next one.
         returns: the total virus population at the end of the update (an
         integer)
         """
         for i in range(len(self.viruses)-1, -1, -1):
             if self.viruses[i].doesClear():
                 self.viruses.pop(i)
-        current_popDensity=self.getTotalPop()/self.maxPop
-        for virus in self.viruses:
+        survivors=self.getTotalPop()
+        current_popDensity=survivors/self.maxPop
+        for virus in self.viruses[:survivors]:
             try:
                 self.viruses.append(virus.reproduce(current_popDensity))
             except NoChildException:
                 pass
         return self.getTotalPop()
 
+    def advance(self, numSteps):
+        """
+        Runs numSteps updates in one call. An extinct population stays
+        extinct, so the updates left once it is empty are skipped (observers
+        of a Patient are not called for them).
+        returns: the total virus population at the end (an integer)
+        """
+        for m in range(numSteps):
+            if not self.viruses:
+                break
+            self.update()
+        return self.getTotalPop()
+
 class NoChildException(Exception):
     """
     a NoChildException indicating that the virus particle does not reproduce during the current time step.
     """
     pass
 
+def _pylab(headless=False):
+    """
+    Imports pylab on first use, so that importing this module neither loads
+    matplotlib nor needs a display.
+    headless: select the non-interactive Agg backend, for figures that are
+    only written to files
+    returns: the pylab module
+    """
+    if headless:
+        import matplotlib
+        matplotlib.use('Agg')
+    import pylab
+    return pylab
+
+
 def problem2():
     """
         Run the simulation and plot the graph for problem 2 (no drugs are used,
@@ -131,6 +327,7 @@ def problem2():
     for i in range(1,timesteps+1):
         x_time.append(i)
         y_pop.append(single_patient.update())
+    pl = _pylab()
     pl.plot(x_time,y_pop)
     pl.xlabel("time step")
     pl.ylabel("virus population")
@@ -142,12 +339,14 @@ def problem2():
 
 class ResistantVirus(SimpleVirus):
     """
-    Representation of a virus which can have drug resistance.
+    Representation of a virus which can have drug resistance. Its Genotype
+    also provides the resistances (a read-only dictionary) and mutProb.
     """
+    __slots__ = ()
 
     def __init__(self, maxBirthProb, clearProb, resistances, mutProb):
         """
-        Initialize a ResistantVirus instance, saves all parameters as attributes of the instance.
+        Initialize a ResistantVirus instance, saves all parameters in the interned Genotype of the instance.
         maxBirthProb: Maximum reproduction probability (a float between 0-1)
         clearProb: Maximum clearance probability (a float between 0-1).
         resistances: A dictionary of drug names (strings) mapping to the state
@@ -157,10 +356,23 @@ class ResistantVirus(SimpleVirus):
         mutProb: Mutation probability for this virus particle (a float). This is
         the probability of the offspring acquiring or losing resistance to a drug.
         """
-        self.maxBirthProb = maxBirthProb
-        self.clearProb = clearProb
-        self.resistances = resistances
-        self.mutProb = mutProb
+        self.genotype = Genotype.get(maxBirthProb, clearProb, resistances, mutProb)
+
+    @property
+    def resistances(self):
+        return self.genotype.resistances
+
+    @resistances.setter
+    def resistances(self, resistances):
+        self.genotype = Genotype.get(self.maxBirthProb, self.clearProb, resistances, self.mutProb)
+
+    @property
+    def mutProb(self):
+        return self.genotype.mutProb
+
+    @mutProb.setter
+    def mutProb(self, mutProb):
+        self.genotype = Genotype.get(self.maxBirthProb, self.clearProb, self.resistances, mutProb)
 
     def getResistance(self, drug):
         """
@@ -171,7 +383,7 @@ class ResistantVirus(SimpleVirus):
         returns: True if this virus instance is resistant to the drug, False
         otherwise.
         """
-        return self.resistances.get(drug, False)
+        return self.genotype.resistances.get(drug, False)
 
 
     def reproduce(self, popDensity, activeDrugs):
@@ -209,18 +421,13 @@ class ResistantVirus(SimpleVirus):
         maxBirthProb and clearProb values as this virus. Raises a
         NoChildException if this virus particle does not reproduce.
         """
-        for drug in activeDrugs:
-            if not self.getResistance(drug):
-                raise NoChildException()
-
-        if random.random() <= (self.maxBirthProb * (1 - popDensity)):
-            newresistances = {}
-            for drug in self.resistances.keys():
-                if random.random() <= (1 - self.mutProb):
-                    newresistances[drug] = self.resistances[drug]
-                else:
-                    newresistances[drug] = not self.resistances[drug]
-            return ResistantVirus(self.maxBirthProb, self.clearProb, newresistances, self.mutProb)
+        genotype = self.genotype
+        required = genotype.blockMask(activeDrugs)
+        if (genotype.mask & required) != required:
+            raise NoChildException()
+
+        if random.random() <= (genotype.maxBirthProb * (1 - popDensity)):
+            return type(self).fromGenotype(genotype.mutate())
         else:
             raise NoChildException()
 
@@ -239,10 +446,18 @@ class Patient(SimplePatient):
         viruses: the list representing the virus population (a list of
         SimpleVirus instances)
         maxPop: the  maximum virus population for this patient (an integer)
+        The patient keeps genotypeCounts, the number of particles per set of
+        drugs they are resistant to, up to date as particles are cleared and
+        born, so viruses should only be changed through update().
         """
         self.viruses=viruses
         self.maxPop=maxPop
         self.administered=[]
+        self.genotypeCounts={}
+        self.observers=[]
+        for virus in viruses:
+            key = _genotypeKey(virus)
+            self.genotypeCounts[key] = self.genotypeCounts.get(key, 0) + 1
 
     def addPrescription(self, newDrug):
         """
@@ -255,6 +470,16 @@ class Patient(SimplePatient):
         if newDrug not in self.administered:
             self.administered.append(newDrug)
 
+    def removePrescription(self, drug):
+        """
+        Stop administering a drug to this patient. If the drug is not
+        prescribed to this patient, the method has no effect.
+        drug: The name of the drug to stop (a string).
+        postcondition: list of drugs being administered to a patient is updated
+        """
+        if drug in self.administered:
+            self.administered.remove(drug)
+
     def getPrescriptions(self):
         """
         Returns the drugs that are being administered to this patient.
@@ -270,13 +495,11 @@ class Patient(SimplePatient):
         of strings - e.g. ['guttagonol'] or ['guttagonol', 'grimpex'])
         returns: the population of viruses (an integer) with resistances to all drugs in the drugResist list.
         """
-        notresist_pop=0
-        for virus in self.viruses:
-            for drug in drugResist:
-                if virus.getResistance(drug)== False:
-                    notresist_pop=notresist_pop +1
-                    break
-        resist_pop=len(self.viruses)-notresist_pop
+        drugResist = frozenset(drugResist)
+        resist_pop=0
+        for key, count in self.genotypeCounts.items():
+            if drugResist <= key:
+                resist_pop=resist_pop+count
         return resist_pop
 
     def update(self):
@@ -287,219 +510,2540 @@ class Patient(SimplePatient):
         - The current population density is calculated. This population density value is used until the next call to update().
         - Determine whether each virus particle should reproduce and add offspring virus particles to the list of viruses in this patient.
         The list of drugs being administered should be accounted for in the determination of whether each virus particle reproduces.
+        Only the particles that survived reproduce: offspring born during the update do not reproduce before the next one.
+        returns: the total virus population at the end of the update (an integer)
+        """
+        if self.observers:
+            return self._observedUpdate()
+        return self._step()
+
+    def _step(self, stats=None):
+        """
+        The body of update(), shared with _observedUpdate(): counts the
+        cleared, blocked, born and mutated particles and times the phases into
+        stats if given.
         returns: the total virus population at the end of the update (an integer)
         """
+        counts = self.genotypeCounts
+        observed = stats is not None
+        if observed:
+            start = time.perf_counter()
         for i in range(len(self.viruses) - 1, -1, -1):
             if self.viruses[i].doesClear():
-                self.viruses.pop(i)
-        current_popDensity = len(self.viruses) / self.maxPop
-        for virus in self.viruses:
+                key = _genotypeKey(self.viruses.pop(i))
+                counts[key] -= 1
+                if counts[key] == 0:
+                    del counts[key]
+                if observed:
+                    stats.cleared += 1
+        if observed:
+            cleared = time.perf_counter()
+        survivors = len(self.viruses)
+        current_popDensity = survivors / self.maxPop
+        for virus in self.viruses[:survivors]:
+            if observed:
+                genotype = virus.genotype
+                required = genotype.blockMask(self.administered)
+                if (genotype.mask & required) != required:
+                    stats.blocked += 1
             try:
-                self.viruses.append(virus.reproduce(current_popDensity, self.administered))
+                child = virus.reproduce(current_popDensity, self.administered)
             except NoChildException:
-                pass
+                if observed:
+                    stats.exceptions += 1
+                continue
+            self.viruses.append(child)
+            key = _genotypeKey(child)
+            counts[key] = counts.get(key, 0) + 1
+            if observed:
+                stats.born += 1
+                flipped = child.genotype.mask ^ virus.genotype.mask
+                for i, drug in enumerate(child.genotype.drugs):
+                    if flipped >> i & 1:
+                        stats.mutated[drug] = stats.mutated.get(drug, 0) + 1
+        if observed:
+            stats.times = {'clearance': cleared - start, 'reproduction': time.perf_counter() - cleared}
+            stats.totalPop = self.getTotalPop()
         return self.getTotalPop()
 
+    def addObserver(self, observer):
+        """
+        Attaches an observer, called as observer(patient, stats) after every
+        update() with the StepStats of the step. Updates take a separate,
+        instrumented path only while observers are attached.
+        """
+        self.observers.append(observer)
 
-def problem4():
-    """
-         Runs simulations and plots graphs for problem 4.
-         Instantiates a patient, runs a simulation for 150 timesteps, adds
-         guttagonol, and runs the simulation for an additional 150 timesteps.
-         total virus population vs. time  and guttagonol-resistant virus population
-         vs. time are plotted
-    """
-    len_viruses = 100
-    maxPop = 1000
-    maxBirthProb = 0.1
-    clearProb = 0.05
-    resistances = {'guttagonol': False}
-    mutProb = 0.005
-    timesteps = 300
-    resistant_virus = ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)
-    viruses = []
-    for i in range(len_viruses):
-        viruses.append(resistant_virus)
-    single_patient = Patient(viruses, maxPop)
+    def removeObserver(self, observer):
+        """
+        Detaches an observer added with addObserver().
+        """
+        self.observers.remove(observer)
 
-    x_time = [0]
-    y_pop = [100]
-    y_pop_resistant = [0]
-    for i in range(1, timesteps + 1):
-        x_time.append(i)
-        y_pop.append(single_patient.update())
-        y_pop_resistant.append(single_patient.getResistPop(['guttagonol']))
-        if i == 150:
-            single_patient.addPrescription("guttagonol")
+    def _observedUpdate(self):
+        """
+        update() with per-step counters and phase timings, reported to the
+        observers.
+        """
+        stats = StepStats(self.administered)
+        self._step(stats)
+        for observer in list(self.observers):
+            observer(self, stats)
+        return stats.totalPop
 
-    pl.plot(x_time, y_pop,label="Total virus population")
-    pl.plot(x_time, y_pop_resistant,label="guttagonol-resistant population")
-    pl.xlabel("time step")
-    pl.ylabel("virus population")
-    pl.title("Simulating Virus Population Dynamics with Drug Treatment")
-    pl.legend()
-    pl.show()
+    def snapshot(self):
+        """
+        Records the state of this patient together with the state of the
+        random module, which drives the virus particles.
+        returns: a snapshot to pass to restore()
+        """
+        return {'viruses': list(self.viruses), 'administered': list(self.administered),
+                'genotypeCounts': dict(self.genotypeCounts), 'randomState': random.getstate()}
+
+    def restore(self, snapshot):
+        """
+        Puts this patient, and the random module, back in the state recorded
+        by snapshot(), so the following updates repeat those made after it.
+        """
+        self.viruses = list(snapshot['viruses'])
+        self.administered = list(snapshot['administered'])
+        self.genotypeCounts = dict(snapshot['genotypeCounts'])
+        random.setstate(snapshot['randomState'])
+
+    def fork(self):
+        """
+        returns: an independent copy of this patient (a Patient), without
+        observers. Both keep drawing from the shared random module.
+        """
+        child = copy.copy(self)
+        child.observers = []
+        child.viruses = list(self.viruses)
+        child.administered = list(self.administered)
+        child.genotypeCounts = dict(self.genotypeCounts)
+        return child
 
-#problem4()
 
-def problem5():
+class StepStats(object):
     """
-    Runs simulations and make histograms for problem 5.
-    Runs multiple simulations to show the relationship between delayed treatment and patient outcome.
-    Histograms of final total virus populations are displayed for delays of 300,150, 75, 0 timesteps
-    (followed by an additional 150 timesteps of simulation).
+    Counters of one Patient.update(), passed to the observers of the patient.
+    cleared, born: the number of particles cleared and born
+    mutated: the number of offspring whose resistance to a drug differs from
+    their parent's (a dictionary keyed by drug name)
+    blocked: the number of particles prevented from reproducing by an
+    administered drug they are not resistant to
+    exceptions: the number of NoChildException raised by reproduce()
+    times: the wall time in seconds of the 'clearance' and 'reproduction'
+    phases (a dictionary)
+    totalPop: the total virus population after the update
     """
-    patientsnum = 200
-    len_viruses = 100
-    maxPop = 1000
-    maxBirthProb = 0.1
-    clearProb = 0.05
-    resistances = {'guttagonol': False}
-    mutProb = 0.005
-    timesteps = 150
-    resistant_virus = ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)
-    delay_timesteps=[300,150,75,0]
-    for delaytime in delay_timesteps:
-        y_pop_total = []
-        cured_num=0
-        for i in range(patientsnum):
-            viruses = []
-            for j in range(len_viruses):
-                viruses.append(resistant_virus)
-            single_patient = Patient(viruses, maxPop)
-            #y_pop = [100]
-            for m in range(delaytime + timesteps):
-                y_pop = single_patient.update()
-                if m == delaytime:
-                    single_patient.addPrescription("guttagonol")
-            y_pop_total.append(y_pop)
-            if y_pop<=50:
-                cured_num=cured_num+1
-        cured_prob=cured_num/patientsnum
-        pl.hist(y_pop_total)
-        pl.title(str(cured_prob*100) + "% of patients were cured when the drug added after " + str(delaytime) + " timesteps")
-        pl.xlabel('Total virus populations')
-        pl.ylabel('Number of patients')
-        pl.show()
+    def __init__(self, administered):
+        self.administered = list(administered)
+        self.cleared = 0
+        self.born = 0
+        self.mutated = {}
+        self.blocked = 0
+        self.exceptions = 0
+        self.times = {}
+        self.totalPop = 0
 
-#problem5()
+
+class PlateauMonitor(object):
+    """
+    Observer that detects a run stuck at carrying capacity: the total
+    population has stayed within tolerance (relative to its mean) over the
+    last window updates while births balance clearances.
+    """
+    def __init__(self, window=50, tolerance=0.05):
+        """
+        window: the number of updates considered (an integer)
+        tolerance: the largest (max - min) / mean of the population and the
+        largest |born - cleared| / cleared over the window (a float)
+        """
+        self.window = window
+        self.tolerance = tolerance
+        self.history = collections.deque(maxlen=window)
+        self.steps = 0
+        self.stuckSince = None
+
+    def __call__(self, patient, stats):
+        self.steps += 1
+        self.history.append((stats.totalPop, stats.born, stats.cleared))
+        stuck = False
+        if len(self.history) == self.window:
+            pops = [pop for pop, born, cleared in self.history]
+            mean = sum(pops) / self.window
+            born = sum(born for pop, born, cleared in self.history)
+            cleared = sum(cleared for pop, born, cleared in self.history)
+            stuck = (mean > 0 and max(pops) - min(pops) <= self.tolerance * mean
+                     and abs(born - cleared) <= self.tolerance * cleared)
+        if not stuck:
+            self.stuckSince = None
+        elif self.stuckSince is None:
+            self.stuckSince = self.steps - self.window + 1
+
+    def isStuck(self):
+        """
+        returns: True if the last window updates were at a plateau; stuckSince
+        then holds the update (counted from 1) where it started.
+        """
+        return self.stuckSince is not None
 
 
-def problem6():
+def _genotypeKey(virus):
     """
-         Runs simulations and make histograms for problem 6.
-         Runs multiple simulations to show the relationship between administration
-         of multiple drugs and patient outcome.
-         Histograms of final total virus populations are displayed for lag times of
-         150, 75, 0 timesteps between adding drugs (followed by an additional 150
-         timesteps of simulation).
+    returns: the set of drugs a virus particle is resistant to (a frozenset,
+    empty for a SimpleVirus)
     """
-    patientsnum = 30
-    len_viruses = 100
-    maxPop = 1000
-    maxBirthProb = 0.1
-    clearProb = 0.05
-    resistances = {'guttagonol': False, 'grimpex':False}
-    mutProb = 0.005
-    timesteps = 150
-    resistant_virus = ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)
-    lag_timesteps = [300, 150, 75, 0]
-    for lagtime in lag_timesteps:
-        y_pop_total = []
-        cured_num = 0
-        for i in range(patientsnum):
-            viruses = []
-            for j in range(len_viruses):
-                viruses.append(resistant_virus)
-            single_patient = Patient(viruses, maxPop)
-            # y_pop = [100]
-            for m in range(timesteps + lagtime + timesteps):
-                y_pop = single_patient.update()
-                if m == timesteps:
-                    single_patient.addPrescription("guttagonol")
-                if m == (timesteps+lagtime):
-                    single_patient.addPrescription("grimpex")
-            y_pop_total.append(y_pop)
-            if y_pop <= 50:
-                cured_num = cured_num + 1
-        #print(y_pop_total)
-        cured_prob = cured_num / patientsnum
-        pl.hist(y_pop_total)
-        pl.title(str(cured_prob * 100) + "% of patients were cured when the interval of two drugs is " + str(lagtime) + " timesteps")
-        pl.xlabel('Total virus populations')
-        pl.ylabel('Number of patients')
-        pl.show()
+    genotype = getattr(virus, 'genotype', None)
+    if genotype is not None:
+        return genotype.resistantDrugs
+    resistances = getattr(virus, 'resistances', None)
+    if not resistances:
+        return frozenset()
+    return frozenset(drug for drug, resistant in resistances.items() if resistant)
 
-problem6()
 
-def problem7():
+class CountPatient(object):
     """
-         Run simulations and plot graphs examining the relationship between
-         administration of multiple drugs and patient outcome.
-         Plots of total and drug-resistant viruses vs. time are made for a
-         simulation with a 300 time step delay between administering the 2 drugs and
-         a simulations for which drugs are administered simultaneously.
+    Representation of a patient whose virus population is stored as counts per
+    resistance genotype instead of as a list of virus particles. A genotype is
+    an integer bitmask over the drugs of the initial resistances: bit i is set
+    when the particles are resistant to the i-th drug. Each time step draws the
+    number of cleared particles, births and per-drug mutations of every
+    genotype with numpy binomial draws, so update() costs O(#genotypes) rather
+    than O(#particles). The stepping engine is pluggable (see BinomialEngine,
+    GillespieEngine, TauLeapEngine, HybridEngine and AutoEngine).
     """
-    #150-300-150
-    len_viruses = 100
-    maxPop = 1000
-    maxBirthProb = 0.1
-    clearProb = 0.05
-    resistances = {'guttagonol': False, 'grimpex': False}
-    mutProb = 0.005
-    timesteps = 150
-    lag_time=300
-    resistant_virus = ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)
-    viruses = []
-    for j in range(len_viruses):
-        viruses.append(resistant_virus)
-    single_patient = Patient(viruses, maxPop)
-    y_pop = []
-    resist_gut = []
-    resist_gri = []
-    resist_all = []
-    for m in range(timesteps+lag_time+timesteps):
-        y_pop.append(single_patient.update())
-        resist_gut.append(single_patient.getResistPop(['guttagonol']))
-        resist_gri.append(single_patient.getResistPop(['grimpex']))
-        resist_all.append(single_patient.getResistPop(['guttagonol', 'grimpex']))
-        if m == timesteps:
-            single_patient.addPrescription("guttagonol")
-        if m == (timesteps + lag_time):
-            single_patient.addPrescription("grimpex")
-    pl.plot(y_pop,label = 'Total virus population')
-    pl.plot(resist_gut,label = 'guttagonol-resistant')
-    pl.plot(resist_gri,label = 'grimpex-resistant')
-    pl.plot(resist_all,label = 'all-resistant')
-    pl.xlabel('virus populations')
-    pl.ylabel('Number of patients')
-    pl.legend()
-    pl.show()
+    def __init__(self, maxBirthProb, clearProb, resistances, mutProb, numViruses, maxPop, rng=None, engine=None):
+        """
+        Initialization function, saves the parameters as attributes and puts
+        all numViruses initial particles in the genotype given by resistances.
+        maxBirthProb: Maximum reproduction probability (a float between 0-1)
+        clearProb: Maximum clearance probability (a float between 0-1).
+        resistances: A dictionary of drug names (strings) mapping to the
+        initial resistance (True or False) to each drug. Its keys are the drugs
+        whose resistance is tracked.
+        mutProb: Mutation probability of a resistance trait per offspring (a float).
+        numViruses: the initial virus population (an integer)
+        maxPop: the  maximum virus population for this patient (an integer)
+        rng: the numpy.random.Generator used for all draws (a fresh one is
+        created if None), three Generators drawing the clearance, birth and
+        mutation events respectively, or a CommonStreams (see patientStreams)
+        engine: the object advancing the counts in update() (a BinomialEngine
+        if None)
+        """
+        self.maxBirthProb = maxBirthProb
+        self.clearProb = clearProb
+        self.mutProb = mutProb
+        self.maxPop = maxPop
+        self.drugs = list(resistances.keys())
+        self.genotypes = numpy.arange(2 ** len(self.drugs))
+        self.counts = numpy.zeros(len(self.genotypes), dtype=numpy.int64)
+        self.counts[self.getMask([drug for drug in self.drugs if resistances[drug]])] = numViruses
+        self.administered = []
+        if rng is None:
+            rng = numpy.random.default_rng()
+        if engine is None:
+            engine = BinomialEngine()
+        self.streams = None
+        self.updates = 0
+        if isinstance(rng, CommonStreams):
+            self.streams = rng
+            rng = rng.at(0)
+        if isinstance(rng, numpy.random.Generator):
+            rng = (rng, rng, rng)
+        self.rngs = tuple(rng)
+        self.rng = self.rngs[0]
+        self.engine = engine
+
+    @classmethod
+    def fromViruses(cls, viruses, maxPop, rng=None, engine=None):
+        """
+        Builds a CountPatient holding the same population as a list of
+        ResistantVirus (or SimpleVirus) instances, e.g. the viruses list of a
+        Patient. All particles must share maxBirthProb, clearProb, mutProb and
+        the set of drugs in their resistances, which are read from them; an
+        empty list raises ValueError (build the CountPatient directly with
+        numViruses=0 instead).
+        viruses: the list representing the virus population
+        maxPop: the  maximum virus population for this patient (an integer)
+        returns: a new CountPatient
+        """
+        if not viruses:
+            raise ValueError("cannot infer the virus parameters of an empty population; "
+                             "use CountPatient(..., numViruses=0, ...) instead")
+        first = viruses[0]
+        resistances = getattr(first, 'resistances', {})
+        mutProb = getattr(first, 'mutProb', 0)
+        patient = cls(first.maxBirthProb, first.clearProb, resistances, mutProb, 0, maxPop, rng, engine)
+        drugs = tuple(resistances)
+        for virus in viruses:
+            if (virus.maxBirthProb != first.maxBirthProb or virus.clearProb != first.clearProb
+                    or getattr(virus, 'mutProb', 0) != mutProb):
+                raise ValueError("all viruses must share maxBirthProb, clearProb and mutProb")
+            if tuple(getattr(virus, 'resistances', {})) != drugs:
+                raise ValueError("all viruses must have resistances to the same drugs")
+            patient.counts[patient.getMask([drug for drug in patient.drugs if virus.getResistance(drug)])] += 1
+        return patient
+
+    def getMask(self, drugList):
+        """
+        Get the genotype bitmask of a list of drugs. A drug whose resistance is
+        not tracked maps to a bit no genotype has, so that no particle counts
+        as resistant to it.
+        drugList: a list of drug names (strings)
+        returns: the bitmask (an integer)
+        """
+        mask = 0
+        for drug in drugList:
+            if drug in self.drugs:
+                mask |= 1 << self.drugs.index(drug)
+            else:
+                mask |= 1 << len(self.drugs)
+        return mask
+
+    def addPrescription(self, newDrug):
+        """
+        Administer a drug to this patient. If the newDrug is already prescribed
+        to this patient, the method has no effect.
+        newDrug: The name of the drug to administer to the patient (a string).
+        """
+        if newDrug not in self.administered:
+            self.administered.append(newDrug)
+
+    def removePrescription(self, drug):
+        """
+        Stop administering a drug to this patient. If the drug is not
+        prescribed to this patient, the method has no effect.
+        drug: The name of the drug to stop (a string).
+        """
+        if drug in self.administered:
+            self.administered.remove(drug)
+
+    def getPrescriptions(self):
+        """
+        returns: The list of drug names (strings) being administered to this
+        patient.
+        """
+        return self.administered
+
+    def getTotalPop(self):
+        """
+        Gets the current total virus population.
+        returns: The total virus population (an integer)
+        """
+        return int(round(self.counts.sum()))
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in drugResist.
+        drugResist: Which drug resistances to include in the population (a list
+        of strings - e.g. ['guttagonol'] or ['guttagonol', 'grimpex'])
+        returns: the population of viruses (an integer) with resistances to all drugs in the drugResist list.
+        """
+        mask = self.getMask(drugResist)
+        return int(round(self.counts[(self.genotypes & mask) == mask].sum()))
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step with its engine. The default engine follows the order of
+        Patient.update(): clearance, then the population density, then
+        reproduction (blocked for every genotype that is not resistant to all
+        administered drugs) with per-drug mutation of the offspring.
+        returns: the total virus population at the end of the update (an
+        integer)
+        """
+        self._nextStreams()
+        self.engine.step(self)
+        return self.getTotalPop()
+
+    def _nextStreams(self):
+        """
+        Positions common random number streams at the draws of the coming
+        update and counts the update.
+        """
+        if self.streams is not None:
+            self.rngs = self.streams.at(self.updates)
+            self.rng = self.rngs[0]
+        self.updates += 1
+
+    def advance(self, numSteps):
+        """
+        Runs numSteps updates in one call. Once every particle is cleared (in
+        every patient of a Cohort) the counts can no longer change, so the
+        remaining updates are skipped.
+        returns: the total virus population at the end, as getTotalPop()
+        """
+        for m in range(numSteps):
+            if not self.counts.any():
+                break
+            self.update()
+        return self.getTotalPop()
+
+    def snapshot(self):
+        """
+        Records the state of this patient, including the state of its random
+        number generator.
+        returns: a snapshot to pass to restore()
+        """
+        return {'counts': self.counts.copy(), 'administered': copy.deepcopy(self.administered),
+                'rngStates': [copy.deepcopy(rng.bit_generator.state) for rng in self.rngs],
+                'updates': self.updates}
+
+    def restore(self, snapshot):
+        """
+        Puts this patient back in the state recorded by snapshot(), so the
+        following updates repeat those made after it.
+        """
+        self.counts = snapshot['counts'].copy()
+        self.administered = copy.deepcopy(snapshot['administered'])
+        self.updates = snapshot['updates']
+        for rng, state in zip(self.rngs, snapshot['rngStates']):
+            rng.bit_generator.state = copy.deepcopy(state)
+
+    def fork(self):
+        """
+        returns: an independent copy of this patient with its own copy of the
+        random number generators, so it continues exactly as this patient would.
+        """
+        child = copy.copy(self)
+        child.streams = copy.deepcopy(self.streams)
+        child.rngs = copy.deepcopy(self.rngs)
+        child.rng = child.rngs[0]
+        child.restore(self.snapshot())
+        return child
+
+
+class Cohort(CountPatient):
+    """
+    Representation of a cohort of patients that share the virus parameters and
+    are advanced together. The genotype counts are a 2-D array (patients x
+    genotypes) and every time step is one set of vectorized binomial draws for
+    the whole cohort. Each patient has its own list of administered drugs.
+    """
+    def __init__(self, maxBirthProb, clearProb, resistances, mutProb, numViruses, maxPop, numPatients, rng=None):
+        """
+        Initialization function, same parameters as CountPatient plus
+        numPatients: the number of patients in the cohort (an integer)
+        """
+        CountPatient.__init__(self, maxBirthProb, clearProb, resistances, mutProb, numViruses, maxPop, rng)
+        self.numPatients = numPatients
+        self.counts = numpy.tile(self.counts, (numPatients, 1))
+        self.activeMasks = numpy.zeros((numPatients, 1), dtype=numpy.int64)
+        self.administered = [[] for i in range(numPatients)]
+
+    def addPrescription(self, newDrug, patients=None):
+        """
+        Administer a drug to some patients of the cohort. Patients that already
+        take newDrug are not affected.
+        newDrug: The name of the drug to administer (a string).
+        patients: the indices of the patients receiving the drug (an iterable
+        of integers, or None for the whole cohort)
+        """
+        if patients is None:
+            patients = range(self.numPatients)
+        mask = self.getMask([newDrug])
+        for i in patients:
+            if newDrug not in self.administered[i]:
+                self.administered[i].append(newDrug)
+                self.activeMasks[i] |= mask
+
+    def removePrescription(self, drug, patients=None):
+        """
+        Stop administering a drug to some patients of the cohort. Patients that
+        do not take the drug are not affected.
+        drug: The name of the drug to stop (a string).
+        patients: the indices of the patients (an iterable of integers, or
+        None for the whole cohort)
+        """
+        if patients is None:
+            patients = range(self.numPatients)
+        for i in patients:
+            if drug in self.administered[i]:
+                self.administered[i].remove(drug)
+                self.activeMasks[i] = self.getMask(self.administered[i])
+
+    def getPrescriptions(self, patient=0):
+        """
+        returns: The list of drug names (strings) being administered to the
+        given patient (an integer index).
+        """
+        return self.administered[patient]
+
+    def getTotalPop(self):
+        """
+        returns: the total virus population of each patient (a numpy array)
+        """
+        return self.counts.sum(axis=1)
+
+    def getResistPop(self, drugResist):
+        """
+        drugResist: Which drug resistances to include in the population (a list
+        of strings)
+        returns: the population of viruses of each patient (a numpy array) with
+        resistances to all drugs in the drugResist list.
+        """
+        mask = self.getMask(drugResist)
+        return self.counts[:, (self.genotypes & mask) == mask].sum(axis=1)
+
+    def update(self):
+        """
+        Update the virus populations of all patients for a single time step.
+        returns: the total virus population of each patient at the end of the
+        update (a numpy array)
+        """
+        self._nextStreams()
+        self.counts = _stepCounts(self.counts, self.genotypes, self.activeMasks,
+                                  self.maxBirthProb, self.clearProb, self.mutProb, self.maxPop,
+                                  len(self.drugs), self.rngs)
+        return self.getTotalPop()
+
+    def snapshot(self):
+        """
+        Records the state of the cohort, see CountPatient.snapshot().
+        """
+        snapshot = CountPatient.snapshot(self)
+        snapshot['activeMasks'] = self.activeMasks.copy()
+        return snapshot
+
+    def restore(self, snapshot):
+        """
+        Puts the cohort back in the state recorded by snapshot().
+        """
+        CountPatient.restore(self, snapshot)
+        self.activeMasks = snapshot['activeMasks'].copy()
+
+
+class TrajectoryStore(object):
+    """
+    Per-patient, per-update virus populations of a cohort kept in a
+    preallocated memory-mapped .npy file, so that cohorts far larger than
+    memory can be recorded once and sliced later without re-simulating.
+    The array has shape (numSteps, numPatients, 1 + number of genotypes):
+    entry [m, i, 0] is the total population of patient i after update m and
+    entry [m, i, 1 + g] the population of genotype g (a bitmask over drugs,
+    as in CountPatient). The drug names are kept in a json file next to it.
+    """
+    def __init__(self, path, mode='r'):
+        """
+        Opens a store written by create().
+        path: the .npy file of the store (a string)
+        mode: 'r' to read or 'r+' to record into it
+        """
+        with open(path + '.json') as f:
+            self.drugs = json.load(f)['drugs']
+        self.path = path
+        self.array = numpy.load(path, mmap_mode=mode)
+        self.genotypes = numpy.arange(2 ** len(self.drugs))
+
+    @classmethod
+    def create(cls, path, numSteps, numPatients, drugs, dtype=numpy.int32):
+        """
+        Preallocates a store for numSteps updates of numPatients patients
+        whose genotypes are tracked over drugs (a list of drug names).
+        returns: the store, open for recording
+        """
+        numpy.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                     shape=(numSteps, numPatients, 1 + 2 ** len(drugs))).flush()
+        with open(path + '.json', 'w') as f:
+            json.dump({'drugs': list(drugs)}, f)
+        return cls(path, 'r+')
+
+    def record(self, step, counts, patients=slice(None)):
+        """
+        Writes the genotype counts of some patients after update step.
+        counts: the counts of each patient (an array of patients x genotypes,
+        or one row of genotype counts for a single patient)
+        patients: the patients written (an index, slice or array of indices)
+        """
+        counts = numpy.rint(counts)
+        self.array[step, patients, 0] = counts.sum(axis=-1)
+        self.array[step, patients, 1:] = counts
+
+    def flush(self):
+        """
+        Writes the recorded populations to the file.
+        """
+        self.array.flush()
+
+    def getTotalPop(self, step=slice(None), patients=slice(None)):
+        """
+        returns: the total populations at the given updates and patients (a
+        numpy array, e.g. of every patient for getTotalPop(150))
+        """
+        return self.array[step, patients, 0]
+
+    def getResistPop(self, drugResist, step=slice(None), patients=slice(None)):
+        """
+        returns: the populations resistant to all drugs in drugResist at the
+        given updates and patients (a numpy array)
+        """
+        mask = 0
+        for drug in drugResist:
+            mask |= 1 << self.drugs.index(drug)
+        columns = 1 + numpy.flatnonzero((self.genotypes & mask) == mask)
+        return self.array[step, patients][..., columns].sum(axis=-1)
+
+
+class Schedule(object):
+    """
+    A treatment schedule: drugs added to or removed from a patient after
+    given updates, kept as a timeline of events by update index. Events
+    after the same update are applied in the order they were scheduled.
+    run() advances the patient with one advance() call per stretch of
+    updates between events instead of checking every update for a due
+    prescription; the updates are still run one by one, except that those
+    left after the population dies out are skipped.
+    """
+    def __init__(self):
+        self.events = {}
+
+    @classmethod
+    def fromPrescriptions(cls, prescriptions):
+        """
+        returns: the schedule of a dictionary mapping each drug name to the
+        update index after which it is added (a Schedule)
+        """
+        schedule = cls()
+        for drug, step in prescriptions.items():
+            schedule.add(drug, step)
+        return schedule
+
+    @classmethod
+    def of(cls, prescriptions):
+        """
+        returns: prescriptions if it is a Schedule, else the schedule of a
+        prescriptions dictionary (empty if None)
+        """
+        if isinstance(prescriptions, cls):
+            return prescriptions
+        return cls.fromPrescriptions(prescriptions or {})
+
+    def add(self, drug, step):
+        """
+        Schedules drug to be administered after update step.
+        returns: this schedule
+        """
+        self.events.setdefault(step, []).append(('add', drug))
+        return self
+
+    def remove(self, drug, step):
+        """
+        Schedules drug to be stopped after update step.
+        returns: this schedule
+        """
+        self.events.setdefault(step, []).append(('remove', drug))
+        return self
+
+    def steps(self):
+        """
+        returns: the update indices after which events happen, in order (a list)
+        """
+        return sorted(self.events)
+
+    def drugs(self):
+        """
+        returns: the drugs named by the events, in order of first appearance
+        (a list)
+        """
+        drugs = []
+        for step in self.steps():
+            for action, drug in self.events[step]:
+                if drug not in drugs:
+                    drugs.append(drug)
+        return drugs
+
+    def shifted(self, start):
+        """
+        returns: the schedule of the events after updates start and later,
+        with update start becoming update 0 (a Schedule)
+        """
+        schedule = Schedule()
+        for step, events in self.events.items():
+            if step >= start:
+                schedule.events[step - start] = list(events)
+        return schedule
+
+    def toList(self):
+        """
+        returns: the events as [step, action, drug] lists in order, suitable
+        for json (a list)
+        """
+        return [[step, action, drug] for step in self.steps() for action, drug in self.events[step]]
+
+    def apply(self, patient, step):
+        """
+        Applies the events due after update step to patient.
+        """
+        for action, drug in self.events.get(step, ()):
+            if action == 'add':
+                patient.addPrescription(drug)
+            else:
+                patient.removePrescription(drug)
+
+    def run(self, patient, numSteps):
+        """
+        Runs patient through numSteps updates, applying the events due after
+        each of them; events after numSteps - 1 are not applied.
+        patient: a Patient, CountPatient or Cohort
+        returns: the total virus population at the end (see getTotalPop)
+        """
+        done = 0
+        for step in self.steps():
+            if 0 <= step < numSteps:
+                patient.advance(step + 1 - done)
+                self.apply(patient, step)
+                done = step + 1
+        return patient.advance(numSteps - done)
+
+
+def simulateCohort(numPatients, numSteps, prescriptions, maxBirthProb=0.1, clearProb=0.05,
+                   mutProb=0.005, numViruses=100, maxPop=1000, resistances=None, rng=None, store=None):
+    """
+    Runs a cohort of patients through numSteps updates, adding drugs on a per
+    patient schedule.
+    prescriptions: a dictionary mapping each drug name to the update index m
+    after which it is added (the `if m == delaytime` convention of the
+    drivers). The value is an integer for the whole cohort or a sequence with
+    one index per patient.
+    resistances: the initial resistances of the particles (defaults to no
+    resistance to any prescribed drug)
+    store: a TrajectoryStore receiving the populations of every patient
+    after every update, created for numSteps updates, numPatients patients
+    and the drugs of resistances
+    returns: the final total virus population of each patient (a numpy array)
+    """
+    if resistances is None:
+        resistances = dict((drug, False) for drug in prescriptions)
+    cohort = Cohort(maxBirthProb, clearProb, resistances, mutProb, numViruses, maxPop, numPatients, rng)
+    addTimes = dict((drug, numpy.broadcast_to(step, (numPatients,))) for drug, step in prescriptions.items())
+    for m in range(numSteps):
+        cohort.update()
+        if store is not None:
+            store.record(m, cohort.counts)
+        for drug, steps in addTimes.items():
+            due = numpy.flatnonzero(steps == m)
+            if len(due):
+                cohort.addPrescription(drug, due)
+    if store is not None:
+        store.flush()
+    return cohort.getTotalPop()
+
+
+def patientRng(masterSeed, patient, arm=0):
+    """
+    Builds the random number generator of one patient. Every (arm, patient)
+    pair gets an independent stream derived from masterSeed, so a patient's
+    outcome does not depend on which process simulates it or in what order.
+    masterSeed: the seed of the whole experiment (an integer)
+    patient: the index of the patient within its arm (an integer)
+    arm: the index of the experiment arm (an integer)
+    returns: a numpy.random.Generator
+    """
+    return numpy.random.default_rng(numpy.random.SeedSequence(masterSeed, spawn_key=(arm, patient)))
+
+
+_COMMON_STREAMS = 0x63726e
+
+
+class CommonStreams(object):
+    """
+    The common random numbers of one patient: counter-based (Philox)
+    generators for the clearance, birth and mutation events, keyed by
+    masterSeed and the patient index only. at(step) rewinds them to a block
+    of their counter space that depends on the update index alone. Once
+    two arms' populations differ they consume different numbers of variates
+    within an update, and this rewinding lines the arms up again at the
+    start of the next one.
+    """
+    def __init__(self, masterSeed, patient):
+        seed = numpy.random.SeedSequence(masterSeed, spawn_key=(_COMMON_STREAMS, patient))
+        keys = seed.generate_state(6, numpy.uint64)
+        self.rngs = tuple(numpy.random.Generator(numpy.random.Philox(key=key)) for key in keys.reshape(3, 2))
+
+    def at(self, step):
+        """
+        returns: the clearance, birth and mutation generators, positioned at
+        the start of the draws of update step (a tuple of three
+        numpy.random.Generator)
+        """
+        for rng in self.rngs:
+            state = rng.bit_generator.state
+            state['state']['counter'] = numpy.array([0, 0, 0, step], dtype=numpy.uint64)
+            state['buffer_pos'] = 4
+            state['has_uint32'] = 0
+            state['uinteger'] = 0
+            rng.bit_generator.state = state
+        return self.rngs
+
+
+def patientStreams(masterSeed, patient):
+    """
+    Builds the common random numbers of one patient, derived from masterSeed
+    and the patient index only. Giving patient i the same streams in every
+    arm of an experiment pairs the arms, so that differences between them
+    reflect the treatment rather than sampling noise.
+    returns: a CommonStreams, to pass as the rng of a CountPatient
+    """
+    return CommonStreams(masterSeed, patient)
+
+
+def _taskRng(masterSeed, patient, arm, commonRandomNumbers):
+    """
+    returns: the random number generator(s) of a patient of a worker task
+    """
+    if commonRandomNumbers:
+        return patientStreams(masterSeed, patient)
+    return patientRng(masterSeed, patient, arm)
+
+
+def simulatePatient(numSteps, prescriptions, rng, maxBirthProb=0.1, clearProb=0.05,
+                    mutProb=0.005, numViruses=100, maxPop=1000, resistances=None, engine=None):
+    """
+    Runs a single CountPatient through numSteps updates. The parameters are
+    those of simulateCohort, except that prescriptions is a Schedule or a
+    dictionary with one update index per drug, plus the stepping engine of
+    the patient.
+    returns: the final total virus population (an integer)
+    """
+    schedule = Schedule.of(prescriptions)
+    if resistances is None:
+        resistances = dict((drug, False) for drug in schedule.drugs())
+    patient = CountPatient(maxBirthProb, clearProb, resistances, mutProb, numViruses, maxPop, rng, engine)
+    return schedule.run(patient, numSteps)
+
+
+def simulateArms(patient, arms):
+    """
+    Simulates several treatment arms starting from the same patient, sharing
+    the work they have in common. The events scheduled after the same update
+    in every arm form the schedule of a trunk that is simulated once; each
+    arm is forked from the trunk after the first update where its schedule
+    departs from it, and the rest of its schedule is then run on the branch.
+    patient: the patient at the start of the experiment, which is not
+    modified (a Patient, CountPatient or Cohort)
+    arms: a list of dictionaries with the number of updates ('numSteps') and
+    the schedule ('prescriptions', a Schedule or a dictionary mapping each
+    drug name to the update index after which it is added) of each arm, as
+    taken by simulatePatient
+    returns: the final total virus population of each arm (a list)
+    """
+    schedules = [Schedule.of(arm['prescriptions']) for arm in arms]
+    trunkSchedule = Schedule()
+    for step, events in schedules[0].events.items():
+        if all(schedule.events.get(step) == events for schedule in schedules):
+            trunkSchedule.events[step] = list(events)
+    branchSteps = []
+    for arm, schedule in zip(arms, schedules):
+        own = [step for step in schedule.steps() if step not in trunkSchedule.events]
+        branchSteps.append(min(own + [arm['numSteps'] - 1]))
+    trunk = patient.fork()
+    done = 0
+    finals = [None] * len(arms)
+    for m in sorted(set(branchSteps)):
+        trunkSchedule.shifted(done).run(trunk, m + 1 - done)
+        done = m + 1
+        for armIndex, (arm, schedule) in enumerate(zip(arms, schedules)):
+            if branchSteps[armIndex] != m:
+                continue
+            branch = trunk.fork()
+            if m not in trunkSchedule.events:
+                schedule.apply(branch, m)
+            finals[armIndex] = schedule.shifted(m + 1).run(branch, arm['numSteps'] - m - 1)
+    return finals
+
+
+def _runChunk(task):
+    """
+    Worker function of runCohortParallel: simulates the patients
+    [start, stop) of one arm.
+    """
+    arm, armIndex, start, stop, masterSeed, commonRandomNumbers = task
+    return [simulatePatient(rng=_taskRng(masterSeed, i, armIndex, commonRandomNumbers), **arm)
+            for i in range(start, stop)]
+
+
+def _runBranchedChunk(task):
+    """
+    Worker function of runCohortParallel with sharePrefix: simulates all arms
+    of the patients [start, stop) with simulateArms.
+    returns: one list of final populations (one per arm) for each patient
+    """
+    arms, armIndex, start, stop, masterSeed, commonRandomNumbers = task
+    params = dict(maxBirthProb=0.1, clearProb=0.05, mutProb=0.005, numViruses=100, maxPop=1000,
+                  resistances=None, engine=None)
+    params.update((key, value) for key, value in arms[0].items() if key not in ('numSteps', 'prescriptions'))
+    if params['resistances'] is None:
+        params['resistances'] = dict((drug, False) for arm in arms
+                                     for drug in Schedule.of(arm['prescriptions']).drugs())
+    return [simulateArms(CountPatient(rng=_taskRng(masterSeed, i, 0, commonRandomNumbers), **params), arms)
+            for i in range(start, stop)]
+
+
+def runCohortParallel(arms, numPatients, masterSeed, workers=None, chunkSize=64, sharePrefix=False,
+                      commonRandomNumbers=False, firstPatient=0):
+    """
+    Simulates numPatients patients for each experiment arm on a process pool.
+    Each patient draws from its own patientRng stream, so the results are
+    identical for any number of workers and any chunkSize.
+    arms: a list of dictionaries of simulatePatient keyword arguments (all
+    but rng), one per arm, e.g. one per delay of problem5
+    numPatients: the number of patients per arm (an integer)
+    masterSeed: the seed of the whole experiment (an integer)
+    workers: the number of worker processes (None for one per CPU, 1 to run
+    in this process)
+    chunkSize: the number of patients handed to a worker at a time
+    sharePrefix: simulate all arms of a patient together with simulateArms,
+    so the part of the schedules they share is simulated once. The arms must
+    then differ only in numSteps and prescriptions, and patient i uses the
+    same stream in every arm.
+    commonRandomNumbers: draw patient i of every arm from the same
+    patientStreams instead of an independent patientRng per arm
+    firstPatient: the index of the first patient, so that a shard of a
+    cohort (patients firstPatient to firstPatient + numPatients - 1) gives
+    the same populations as the whole cohort for those patients
+    returns: a list with the final total virus populations of each arm (numpy
+    arrays of length numPatients)
+    """
+    tasks = _cohortTasks(arms, numPatients, masterSeed, chunkSize, sharePrefix, commonRandomNumbers, firstPatient)
+    results = [numpy.zeros(numPatients, dtype=numpy.int64) for arm in arms]
+    for task, pops in zip(tasks, _mapChunks(_runBranchedChunk if sharePrefix else _runChunk, tasks, workers)):
+        if sharePrefix:
+            for armIndex, armPops in enumerate(zip(*pops)):
+                results[armIndex][task[2] - firstPatient:task[3] - firstPatient] = armPops
+        else:
+            results[task[1]][task[2] - firstPatient:task[3] - firstPatient] = pops
+    return results
+
+
+def _cohortTasks(arms, numPatients, masterSeed, chunkSize, sharePrefix, commonRandomNumbers, firstPatient):
+    """
+    returns: the chunks of patients of runCohortParallel, as tasks of
+    _runBranchedChunk (sharePrefix) or _runChunk
+    """
+    tasks = []
+    stop = firstPatient + numPatients
+    if sharePrefix:
+        for start in range(firstPatient, stop, chunkSize):
+            tasks.append((arms, None, start, min(start + chunkSize, stop), masterSeed, commonRandomNumbers))
+    else:
+        for armIndex, arm in enumerate(arms):
+            for start in range(firstPatient, stop, chunkSize):
+                tasks.append((arm, armIndex, start, min(start + chunkSize, stop), masterSeed, commonRandomNumbers))
+    return tasks
+
+
+def _mapChunks(worker, tasks, workers):
+    """
+    returns: an iterator of the results of worker on each task, in order, run
+    on a pool of workers processes (in this process if workers is 1)
+    """
+    if workers == 1:
+        yield from map(worker, tasks)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            yield from pool.map(worker, tasks)
+
+
+def _summarizeChunk(job):
+    """
+    Worker function of summarizeCohortParallel: simulates one chunk of
+    patients and summarizes their final populations.
+    returns: the summary of each arm simulated (a list of PopulationSummary)
+    """
+    worker, task, summary = job
+    pops = worker(task)
+    if worker is _runChunk:
+        pops = [pops]
+    else:
+        pops = list(zip(*pops))
+    return [copy.deepcopy(summary).add(armPops) for armPops in pops]
+
+
+def summarizeCohortParallel(arms, numPatients, masterSeed, summary, workers=None, chunkSize=64, sharePrefix=False,
+                            commonRandomNumbers=False, firstPatient=0):
+    """
+    Simulates a cohort like runCohortParallel, but each worker summarizes the
+    final populations of its chunk of patients, so that no per-patient
+    result is kept. The summaries are identical to those of the final
+    populations returned by runCohortParallel.
+    summary: an empty PopulationSummary setting the histogram bins, cure
+    threshold and quantile accuracy
+    returns: the summary of each arm (a list of PopulationSummary)
+    """
+    tasks = _cohortTasks(arms, numPatients, masterSeed, chunkSize, sharePrefix, commonRandomNumbers, firstPatient)
+    worker = _runBranchedChunk if sharePrefix else _runChunk
+    results = [copy.deepcopy(summary) for arm in arms]
+    chunks = _mapChunks(_summarizeChunk, [(worker, task, summary) for task in tasks], workers)
+    for task, summaries in zip(tasks, chunks):
+        if sharePrefix:
+            for result, chunkSummary in zip(results, summaries):
+                result.merge(chunkSummary)
+        else:
+            results[task[1]].merge(summaries[0])
+    return results
+
+
+class PopulationSummary(object):
+    """
+    Constant-memory summary of the final populations of many patients: a
+    histogram over fixed bins spanning 0 to maxPop (larger values fall in the
+    last bin), the number of cured patients, exact integer sums for the mean
+    and variance, and a quantile sketch whose estimates are within a
+    relative error relativeAccuracy of the true value (logarithmic buckets,
+    as in DDSketch). Everything is an integer count, so summaries of parts
+    of a cohort merge exactly and in any order into the summary of the whole.
+    """
+    def __init__(self, maxPop, bins=20, cureThreshold=50, relativeAccuracy=0.01):
+        """
+        maxPop: the upper end of the histogram (a number)
+        bins: the number of histogram bins (an integer)
+        cureThreshold: the largest final population counted as cured
+        relativeAccuracy: the relative error of the quantiles (a float < 1)
+        """
+        self.maxPop = maxPop
+        self.bins = bins
+        self.cureThreshold = cureThreshold
+        self.relativeAccuracy = relativeAccuracy
+        self.gamma = (1 + relativeAccuracy) / (1 - relativeAccuracy)
+        self.counts = numpy.zeros(bins, dtype=numpy.int64)
+        self.cured = 0
+        self.n = 0
+        self.total = 0
+        self.sumSquares = 0
+        self.zeros = 0
+        self.buckets = {}
+
+    def add(self, pops):
+        """
+        Adds the final populations of some patients (a sequence of integers).
+        returns: this summary
+        """
+        pops = numpy.rint(numpy.asarray(pops, dtype=float)).astype(numpy.int64)
+        edges = numpy.linspace(0, self.maxPop, self.bins + 1)
+        self.counts += numpy.histogram(numpy.minimum(pops, self.maxPop), edges)[0]
+        self.cured += int((pops <= self.cureThreshold).sum())
+        self.n += len(pops)
+        self.total += int(pops.sum())
+        self.sumSquares += sum(pop * pop for pop in pops.tolist())
+        positive = pops[pops > 0]
+        self.zeros += len(pops) - len(positive)
+        keys, counts = numpy.unique(numpy.ceil(numpy.log(positive) / math.log(self.gamma)), return_counts=True)
+        for key, count in zip(keys.astype(int).tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        return self
+
+    def merge(self, other):
+        """
+        Adds the patients summarized by other, which must have the same bins,
+        cure threshold and accuracy.
+        returns: this summary
+        """
+        if (other.maxPop, other.bins, other.cureThreshold, other.relativeAccuracy) != \
+                (self.maxPop, self.bins, self.cureThreshold, self.relativeAccuracy):
+            raise ValueError("summaries with different settings cannot be merged")
+        self.counts += other.counts
+        self.cured += other.cured
+        self.n += other.n
+        self.total += other.total
+        self.sumSquares += other.sumSquares
+        self.zeros += other.zeros
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        return self
+
+    def mean(self):
+        """
+        returns: the mean final population (a float), or None if the summary
+        is empty
+        """
+        if self.n == 0:
+            return None
+        return self.total / self.n
+
+    def variance(self):
+        """
+        returns: the sample variance of the final populations (a float), or
+        None if the summary is empty
+        """
+        if self.n == 0:
+            return None
+        if self.n < 2:
+            return 0.0
+        return (self.n * self.sumSquares - self.total ** 2) / (self.n * (self.n - 1))
+
+    def quantile(self, q):
+        """
+        returns: an estimate of the q-quantile of the final populations (a
+        float, 0 <= q <= 1), or None if the summary is empty
+        """
+        if self.n == 0:
+            return None
+        rank = q * (self.n - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        if not self.buckets:
+            return 0.0
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def report(self, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+        """
+        returns: the statistics of the summary, suitable for json (a
+        dictionary); those of an empty summary are None
+        """
+        curedFraction = self.cured / self.n if self.n else None
+        return {'patients': self.n, 'curedFraction': curedFraction, 'mean': self.mean(),
+                'variance': self.variance(),
+                'quantiles': dict((str(q), self.quantile(q)) for q in quantiles),
+                'histogram': {'edges': numpy.linspace(0, self.maxPop, self.bins + 1).tolist(),
+                              'counts': self.counts.tolist()}}
+
+    def toDict(self):
+        """
+        returns: the full state of the summary, suitable for json, to save a
+        partial result and merge it later (see fromDict)
+        """
+        return {'maxPop': self.maxPop, 'bins': self.bins, 'cureThreshold': self.cureThreshold,
+                'relativeAccuracy': self.relativeAccuracy, 'counts': self.counts.tolist(), 'cured': self.cured,
+                'n': self.n, 'total': self.total, 'sumSquares': self.sumSquares, 'zeros': self.zeros,
+                'buckets': [[key, count] for key, count in sorted(self.buckets.items())]}
+
+    @classmethod
+    def fromDict(cls, state):
+        """
+        returns: the summary saved by toDict() (a PopulationSummary)
+        """
+        summary = cls(state['maxPop'], state['bins'], state['cureThreshold'], state['relativeAccuracy'])
+        summary.counts = numpy.array(state['counts'], dtype=numpy.int64)
+        summary.cured = state['cured']
+        summary.n = state['n']
+        summary.total = state['total']
+        summary.sumSquares = state['sumSquares']
+        summary.zeros = state['zeros']
+        summary.buckets = dict((key, count) for key, count in state['buckets'])
+        return summary
+
+
+def pairedDifferences(finalPops, cureThreshold=50, confidence=0.95):
+    """
+    Compares the arms of an experiment patient by patient, which is only
+    meaningful when patient i of every arm shares its random numbers (common
+    random numbers or arms forked from one patient, see simulateArms). Only
+    the patients present in every arm are compared.
+    finalPops: the final total virus populations of each arm (a list of
+    sequences, patient i at the same position in each)
+    cureThreshold: the largest final population counted as cured
+    returns: a list with one dictionary per pair of arms a < b giving 'arms'
+    [a, b], the mean difference b - a of the cure indicator
+    ('cureDifference') and of the final population ('popDifference'), their
+    standard errors and confidence intervals from the paired differences,
+    and the standard error the cure difference would have if the arms were
+    independent ('unpairedCureStdErr')
+    """
+    numPatients = min(len(pops) for pops in finalPops)
+    pops = [numpy.asarray(armPops[:numPatients], dtype=float) for armPops in finalPops]
+    cured = [(armPops <= cureThreshold).astype(float) for armPops in pops]
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    comparisons = []
+    for a in range(len(pops)):
+        for b in range(a + 1, len(pops)):
+            comparison = {'arms': [a, b], 'patients': numPatients}
+            for name, values in (('cure', cured), ('pop', pops)):
+                differences = values[b] - values[a]
+                mean = float(differences.mean()) if numPatients else 0.0
+                stdErr = float(differences.std(ddof=1) / math.sqrt(numPatients)) if numPatients > 1 else 0.0
+                comparison[name + 'Difference'] = mean
+                comparison[name + 'StdErr'] = stdErr
+                comparison[name + 'Interval'] = (mean - z * stdErr, mean + z * stdErr)
+            if numPatients > 1:
+                comparison['unpairedCureStdErr'] = math.sqrt((cured[a].var(ddof=1) + cured[b].var(ddof=1)) / numPatients)
+            comparisons.append(comparison)
+    return comparisons
+
+
+def wilsonInterval(cured, total, confidence=0.95):
+    """
+    Wilson score confidence interval of a cure rate.
+    cured: the number of cured patients (an integer)
+    total: the number of patients (an integer)
+    confidence: the confidence level (a float between 0-1)
+    returns: the lower and upper bound (a tuple of floats)
+    """
+    if total == 0:
+        return (0.0, 1.0)
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    rate = cured / total
+    centre = (rate + z * z / (2 * total)) / (1 + z * z / total)
+    half = z * math.sqrt(rate * (1 - rate) / total + z * z / (4 * total * total)) / (1 + z * z / total)
+    return (max(centre - half, 0.0), min(centre + half, 1.0))
+
+
+def estimateCureRates(arms, masterSeed, targetWidth=0.05, confidence=0.95, batchSize=100, maxPatients=10000,
+                      cureThreshold=50, workers=None, chunkSize=25, commonRandomNumbers=False):
+    """
+    Estimates the cure rate of each arm sequentially: patients are simulated
+    in batches of batchSize per arm and an arm stops as soon as the confidence
+    interval of its cure rate is narrower than targetWidth ('width'), does not
+    overlap the interval of any other arm ('separated') or maxPatients have
+    been simulated ('maxPatients'). Patient i of arm a always draws from
+    patientRng(masterSeed, i, a), so the estimates are reproducible.
+    arms: a list of dictionaries of simulatePatient keyword arguments (all
+    but rng), one per arm
+    cureThreshold: the largest final population counted as cured
+    workers: the number of worker processes (None for one per CPU, 1 to run
+    in this process)
+    chunkSize: the number of patients handed to a worker at a time
+    commonRandomNumbers: draw patient i of every arm from patientStreams
+    returns: a list with one dictionary per arm giving the final populations
+    ('finalPops'), the number of 'patients' and 'cured', the 'curedFraction',
+    its confidence 'interval' and the 'stopReason'
+    """
+    results = [{'finalPops': [], 'patients': 0, 'cured': 0, 'interval': (0.0, 1.0), 'stopReason': None}
+               for arm in arms]
+    pool = None if workers == 1 else concurrent.futures.ProcessPoolExecutor(workers)
+    try:
+        while True:
+            active = [armIndex for armIndex, result in enumerate(results) if result['stopReason'] is None]
+            if not active:
+                break
+            tasks = []
+            for armIndex in active:
+                start = results[armIndex]['patients']
+                stop = min(start + batchSize, maxPatients)
+                for chunkStart in range(start, stop, chunkSize):
+                    tasks.append((arms[armIndex], armIndex, chunkStart, min(chunkStart + chunkSize, stop), masterSeed,
+                                  commonRandomNumbers))
+            chunks = map(_runChunk, tasks) if pool is None else pool.map(_runChunk, tasks)
+            for task, pops in zip(tasks, chunks):
+                result = results[task[1]]
+                result['finalPops'].extend(pops)
+                result['patients'] += len(pops)
+                result['cured'] += sum(1 for pop in pops if pop <= cureThreshold)
+            for armIndex in active:
+                result = results[armIndex]
+                result['interval'] = wilsonInterval(result['cured'], result['patients'], confidence)
+            for armIndex in active:
+                result = results[armIndex]
+                low, high = result['interval']
+                others = [other['interval'] for otherIndex, other in enumerate(results) if otherIndex != armIndex]
+                if high - low <= targetWidth:
+                    result['stopReason'] = 'width'
+                elif others and all(high < otherLow or low > otherHigh for otherLow, otherHigh in others):
+                    result['stopReason'] = 'separated'
+                elif result['patients'] >= maxPatients:
+                    result['stopReason'] = 'maxPatients'
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    for result in results:
+        result['curedFraction'] = result['cured'] / result['patients'] if result['patients'] else 0.0
+    return results
+
+
+def _stepCounts(counts, genotypes, activeMask, maxBirthProb, clearProb, mutProb, maxPop, numDrugs, rngs):
+    """
+    Advances genotype counts by one time step. counts may carry leading
+    dimensions (e.g. one row per patient); the genotypes are the last axis and
+    activeMask must broadcast against counts. rngs are the Generators of the
+    clearance, birth and mutation draws.
+    returns: the new counts (a numpy array of the same shape)
+    """
+    clearRng, birthRng, mutationRng = rngs
+    survivors = clearRng.binomial(counts, 1 - clearProb)
+    popDensity = survivors.sum(axis=-1, keepdims=True) / maxPop
+    birthProb = numpy.clip(maxBirthProb * (1 - popDensity), 0, 1)
+    eligible = (genotypes & activeMask) == activeMask
+    births = _mutateBirths(birthRng.binomial(survivors * eligible, birthProb), genotypes, mutProb, numDrugs,
+                           mutationRng)
+    return survivors + births
+
+
+def _mutateBirths(births, genotypes, mutProb, numDrugs, rng):
+    """
+    Moves newborn particles between genotypes: every offspring switches each
+    resistance trait independently with probability mutProb.
+    returns: the births per genotype after mutation (a numpy array)
+    """
+    for i in range(numDrugs):
+        mutated = rng.binomial(births, mutProb)
+        births = births - mutated + mutated[..., genotypes ^ (1 << i)]
+    return births
+
+
+class BinomialEngine(object):
+    """
+    Stepping engine of a CountPatient for the discrete-time model of
+    Patient.update(): one time step is one set of binomial draws for
+    clearance, birth and mutation. This is the default engine.
+    """
+    def step(self, patient):
+        """
+        Advances the genotype counts of patient by one time step.
+        """
+        patient.counts = _stepCounts(patient.counts, patient.genotypes, patient.getMask(patient.administered),
+                                     patient.maxBirthProb, patient.clearProb, patient.mutProb, patient.maxPop,
+                                     len(patient.drugs), patient.rngs)
+
+
+class GillespieEngine(object):
+    """
+    Stepping engine of a CountPatient for the continuous-time version of the
+    model, simulated exactly event by event (Gillespie's direct method). Each
+    particle is cleared at rate clearProb and, if resistant to every
+    administered drug, gives birth at rate maxBirthProb * (1 - popDensity),
+    where popDensity follows every event. One time step is one unit of time.
+    The cost grows with the number of events, so it is meant for small
+    populations, e.g. near extinction where cures are decided. All events are
+    drawn from the first generator of the patient.
+    """
+    def step(self, patient):
+        """
+        Advances the genotype counts of patient by one unit of time.
+        """
+        rng = patient.rng
+        activeMask = patient.getMask(patient.administered)
+        counts = numpy.rint(patient.counts).astype(numpy.int64).tolist()
+        eligible = [(genotype & activeMask) == activeMask for genotype in range(len(counts))]
+        total = sum(counts)
+        parents = [count if ok else 0 for count, ok in zip(counts, eligible)]
+        t = 0.0
+        while total > 0:
+            birthRate = max(patient.maxBirthProb * (1 - total / patient.maxPop), 0)
+            clearRate = patient.clearProb * total
+            birthTotal = birthRate * sum(parents)
+            rate = clearRate + birthTotal
+            if rate <= 0:
+                break
+            t += rng.exponential(1 / rate)
+            if t > 1:
+                break
+            u = rng.random() * rate
+            if u < clearRate:
+                genotype = _pickIndex(counts, u / patient.clearProb)
+                counts[genotype] -= 1
+                total -= 1
+            else:
+                genotype = _pickIndex(parents, (u - clearRate) / birthRate)
+                for i in range(len(patient.drugs)):
+                    if rng.random() < patient.mutProb:
+                        genotype ^= 1 << i
+                counts[genotype] += 1
+                total += 1
+            parents[genotype] = counts[genotype] if eligible[genotype] else 0
+        patient.counts = numpy.array(counts, dtype=numpy.int64)
+
+
+def _pickIndex(weights, u):
+    """
+    returns: the index i such that u falls in the i-th interval of the
+    cumulative weights (rounding past the end picks the last positive weight)
+    """
+    chosen = None
+    for index, weight in enumerate(weights):
+        if weight > 0:
+            chosen = index
+            if u < weight:
+                break
+            u -= weight
+    return chosen
+
+
+class TauLeapEngine(object):
+    """
+    Stepping engine of a CountPatient for the continuous-time model of
+    GillespieEngine, simulated approximately by tau-leaping: the events of a
+    leap of length tau are drawn as Poisson numbers. tau is chosen so that the
+    expected change of the total population, and its standard deviation, stay
+    below epsilon times the population, which gives long leaps when the
+    population is large or near equilibrium.
+    """
+    def __init__(self, epsilon=0.03):
+        """
+        epsilon: the largest relative change of the population per leap (a float)
+        """
+        self.epsilon = epsilon
+
+    def step(self, patient):
+        """
+        Advances the genotype counts of patient by one unit of time.
+        """
+        clearRng, birthRng, mutationRng = patient.rngs
+        activeMask = patient.getMask(patient.administered)
+        eligible = (patient.genotypes & activeMask) == activeMask
+        counts = patient.counts
+        t = 0.0
+        while t < 1:
+            total = counts.sum()
+            if total == 0:
+                break
+            birthRate = max(patient.maxBirthProb * (1 - total / patient.maxPop), 0)
+            clearRates = patient.clearProb * counts
+            birthRates = birthRate * counts * eligible
+            drift = abs(birthRates.sum() - clearRates.sum())
+            spread = birthRates.sum() + clearRates.sum()
+            bound = max(self.epsilon * total, 1)
+            tau = 1 - t
+            if drift > 0:
+                tau = min(tau, bound / drift)
+            if spread > 0:
+                tau = min(tau, bound ** 2 / spread)
+            cleared = numpy.minimum(clearRng.poisson(clearRates * tau), counts)
+            births = _mutateBirths(birthRng.poisson(birthRates * tau), patient.genotypes, patient.mutProb,
+                                   len(patient.drugs), mutationRng)
+            counts = counts - cleared + births
+            t += tau
+        patient.counts = counts
+
+
+class HybridEngine(object):
+    """
+    Stepping engine of a CountPatient for very large populations, following
+    the discrete-time model of BinomialEngine. Genotypes with at least
+    threshold particles are abundant and evolve with the mean-field update:
+    a fraction clearProb is cleared and the survivors of eligible genotypes
+    give birth to a fraction maxBirthProb * (1 - popDensity). Rarer genotypes
+    keep the exact binomial draws, and mutants flowing from an abundant
+    genotype into a rare one arrive as a Poisson number, so the emergence of
+    resistance stays stochastic. The counts of abundant genotypes become
+    floats; a genotype dropping below threshold is rounded stochastically
+    back to an integer count.
+    It is not faster than BinomialEngine: numpy's binomial draws already cost
+    the same for any count, and the extra bookkeeping makes each step about
+    0.45-0.9 times as fast (the 'HybridEngine' benchmark case, up to maxPop
+    10^13 and 12 drugs). Its results agree statistically with
+    BinomialEngine, so it only serves as a cross-check of the large
+    population limit.
+    """
+    def __init__(self, threshold=10000):
+        """
+        threshold: the count from which a genotype is treated deterministically
+        (an integer)
+        """
+        self.threshold = threshold
+
+    def step(self, patient):
+        """
+        Advances the genotype counts of patient by one time step.
+        """
+        clearRng, birthRng, mutationRng = patient.rngs
+        genotypes = patient.genotypes
+        activeMask = patient.getMask(patient.administered)
+        eligible = (genotypes & activeMask) == activeMask
+        counts = patient.counts.astype(float)
+        abundant = counts >= self.threshold
+        rare = numpy.floor(numpy.where(abundant, 0, counts))
+        rare += clearRng.random(len(counts)) < numpy.where(abundant, 0, counts) - rare
+        survivors = numpy.where(abundant, counts * (1 - patient.clearProb),
+                                clearRng.binomial(rare.astype(numpy.int64), 1 - patient.clearProb))
+        popDensity = survivors.sum() / patient.maxPop
+        birthProb = min(max(patient.maxBirthProb * (1 - popDensity), 0), 1)
+        meanBirths = numpy.where(abundant & eligible, survivors * birthProb, 0.0)
+        drawnBirths = birthRng.binomial(numpy.where(abundant | ~eligible, 0, survivors).astype(numpy.int64), birthProb)
+        for i in range(len(patient.drugs)):
+            partner = genotypes ^ (1 << i)
+            flow = meanBirths * patient.mutProb
+            meanBirths = meanBirths - flow + numpy.where(abundant, flow[partner], 0.0)
+            mutated = mutationRng.binomial(drawnBirths, patient.mutProb)
+            drawnBirths = (drawnBirths - mutated + mutated[partner] +
+                           mutationRng.poisson(numpy.where(abundant, 0.0, flow[partner])))
+        patient.counts = survivors + meanBirths + drawnBirths
+
+
+class AutoEngine(object):
+    """
+    Stepping engine of a CountPatient that uses one engine while the total
+    population is below switchPop and another one above it, by default exact
+    Gillespie steps for small populations and tau-leaping for large ones.
+    """
+    def __init__(self, switchPop=200, small=None, large=None):
+        """
+        switchPop: the population at which the large engine takes over (an integer)
+        small, large: the engines used below and above switchPop
+        """
+        if small is None:
+            small = GillespieEngine()
+        if large is None:
+            large = TauLeapEngine()
+        self.switchPop = switchPop
+        self.small = small
+        self.large = large
+
+    def step(self, patient):
+        """
+        Advances the genotype counts of patient by one time step with the
+        engine matching its current population.
+        """
+        if patient.getTotalPop() < self.switchPop:
+            self.small.step(patient)
+        else:
+            self.large.step(patient)
+
+
+def problem4():
+    """
+         Runs simulations and plots graphs for problem 4.
+         Instantiates a patient, runs a simulation for 150 timesteps, adds
+         guttagonol, and runs the simulation for an additional 150 timesteps.
+         total virus population vs. time  and guttagonol-resistant virus population
+         vs. time are plotted
+    """
+    len_viruses = 100
+    maxPop = 1000
+    maxBirthProb = 0.1
+    clearProb = 0.05
+    resistances = {'guttagonol': False}
+    mutProb = 0.005
+    timesteps = 300
+    resistant_virus = ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)
+    viruses = []
+    for i in range(len_viruses):
+        viruses.append(resistant_virus)
+    single_patient = Patient(viruses, maxPop)
+
+    x_time = [0]
+    y_pop = [100]
+    y_pop_resistant = [0]
+    for i in range(1, timesteps + 1):
+        x_time.append(i)
+        y_pop.append(single_patient.update())
+        y_pop_resistant.append(single_patient.getResistPop(['guttagonol']))
+        if i == 150:
+            single_patient.addPrescription("guttagonol")
+
+    pl = _pylab()
+    pl.plot(x_time, y_pop,label="Total virus population")
+    pl.plot(x_time, y_pop_resistant,label="guttagonol-resistant population")
+    pl.xlabel("time step")
+    pl.ylabel("virus population")
+    pl.title("Simulating Virus Population Dynamics with Drug Treatment")
+    pl.legend()
+    pl.show()
+
+#problem4()
+
+def problem5(seed=None, workers=None):
+    """
+    Runs simulations and make histograms for problem 5.
+    Runs multiple simulations to show the relationship between delayed treatment and patient outcome.
+    Histograms of final total virus populations are displayed for delays of 300,150, 75, 0 timesteps
+    (followed by an additional 150 timesteps of simulation).
+    seed: if given, the patients are simulated reproducibly from this master
+    seed on a pool of workers processes (see runCohortParallel); otherwise all
+    patients are advanced together as one Cohort. Either way the untreated
+    prefix shared by the delay arms is simulated once (see simulateArms).
+    The patients are count-based (CountPatient, Cohort) rather than lists of
+    ResistantVirus particles; both models draw the same distribution of final
+    populations (see compareModels).
+    """
+    patientsnum = 200
+    len_viruses = 100
+    maxPop = 1000
+    maxBirthProb = 0.1
+    clearProb = 0.05
+    resistances = {'guttagonol': False}
+    mutProb = 0.005
+    timesteps = 150
+    delay_timesteps=[300,150,75,0]
+    arms = [dict(numSteps=delaytime + timesteps, prescriptions={'guttagonol': delaytime},
+                 maxBirthProb=maxBirthProb, clearProb=clearProb, mutProb=mutProb,
+                 numViruses=len_viruses, maxPop=maxPop, resistances=resistances)
+            for delaytime in delay_timesteps]
+    if seed is None:
+        cohort = Cohort(maxBirthProb, clearProb, resistances, mutProb, len_viruses, maxPop, patientsnum)
+        final_pops = simulateArms(cohort, arms)
+    else:
+        final_pops = runCohortParallel(arms, patientsnum, seed, workers, sharePrefix=True)
+    pl = _pylab()
+    for delaytime, y_pop_total in zip(delay_timesteps, final_pops):
+        cured_num = int((y_pop_total <= 50).sum())
+        cured_prob=cured_num/patientsnum
+        pl.hist(y_pop_total)
+        pl.title(str(cured_prob*100) + "% of patients were cured when the drug added after " + str(delaytime) + " timesteps")
+        pl.xlabel('Total virus populations')
+        pl.ylabel('Number of patients')
+        pl.show()
+
+#problem5()
+
+
+def problem6(seed=None, workers=None):
+    """
+         Runs simulations and make histograms for problem 6.
+         Runs multiple simulations to show the relationship between administration
+         of multiple drugs and patient outcome.
+         Histograms of final total virus populations are displayed for lag times of
+         150, 75, 0 timesteps between adding drugs (followed by an additional 150
+         timesteps of simulation).
+         seed, workers: as in problem5, which also describes the model used
+    """
+    patientsnum = 30
+    len_viruses = 100
+    maxPop = 1000
+    maxBirthProb = 0.1
+    clearProb = 0.05
+    resistances = {'guttagonol': False, 'grimpex':False}
+    mutProb = 0.005
+    timesteps = 150
+    lag_timesteps = [300, 150, 75, 0]
+    arms = [dict(numSteps=timesteps + lagtime + timesteps,
+                 prescriptions={'guttagonol': timesteps, 'grimpex': timesteps + lagtime},
+                 maxBirthProb=maxBirthProb, clearProb=clearProb, mutProb=mutProb,
+                 numViruses=len_viruses, maxPop=maxPop, resistances=resistances)
+            for lagtime in lag_timesteps]
+    if seed is None:
+        cohort = Cohort(maxBirthProb, clearProb, resistances, mutProb, len_viruses, maxPop, patientsnum)
+        final_pops = simulateArms(cohort, arms)
+    else:
+        final_pops = runCohortParallel(arms, patientsnum, seed, workers, sharePrefix=True)
+    pl = _pylab()
+    for lagtime, y_pop_total in zip(lag_timesteps, final_pops):
+        cured_num = int((y_pop_total <= 50).sum())
+        #print(y_pop_total)
+        cured_prob = cured_num / patientsnum
+        pl.hist(y_pop_total)
+        pl.title(str(cured_prob * 100) + "% of patients were cured when the interval of two drugs is " + str(lagtime) + " timesteps")
+        pl.xlabel('Total virus populations')
+        pl.ylabel('Number of patients')
+        pl.show()
+
+#problem6()
+
+def problem7():
+    """
+         Run simulations and plot graphs examining the relationship between
+         administration of multiple drugs and patient outcome.
+         Plots of total and drug-resistant viruses vs. time are made for a
+         simulation with a 300 time step delay between administering the 2 drugs and
+         a simulations for which drugs are administered simultaneously.
+    """
+    #150-300-150
+    len_viruses = 100
+    maxPop = 1000
+    maxBirthProb = 0.1
+    clearProb = 0.05
+    resistances = {'guttagonol': False, 'grimpex': False}
+    mutProb = 0.005
+    timesteps = 150
+    lag_time=300
+    resistant_virus = ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)
+    viruses = []
+    for j in range(len_viruses):
+        viruses.append(resistant_virus)
+    single_patient = Patient(viruses, maxPop)
+    y_pop = []
+    resist_gut = []
+    resist_gri = []
+    resist_all = []
+    schedule = Schedule().add("guttagonol", timesteps).add("grimpex", timesteps + lag_time)
+    for snapshot in iterateSimulation(single_patient, timesteps+lag_time+timesteps, schedule, list(resistances)):
+        y_pop.append(snapshot['total'])
+        resist_gut.append(snapshot['resistant']['guttagonol'])
+        resist_gri.append(snapshot['resistant']['grimpex'])
+        resist_all.append(snapshot['resistant']['all'])
+    pl = _pylab()
+    pl.plot(y_pop,label = 'Total virus population')
+    pl.plot(resist_gut,label = 'guttagonol-resistant')
+    pl.plot(resist_gri,label = 'grimpex-resistant')
+    pl.plot(resist_all,label = 'all-resistant')
+    pl.xlabel('virus populations')
+    pl.ylabel('Number of patients')
+    pl.legend()
+    pl.show()
+
+    #150-150
+    viruses = []
+    for j in range(len_viruses):
+        viruses.append(resistant_virus)
+    single_patient = Patient(viruses, maxPop)
+    y_pop = []
+    resist_gut = []
+    resist_gri = []
+    resist_all = []
+    schedule = Schedule().add("guttagonol", timesteps).add("grimpex", timesteps)
+    for snapshot in iterateSimulation(single_patient, timesteps+timesteps, schedule, list(resistances)):
+        y_pop.append(snapshot['total'])
+        resist_gut.append(snapshot['resistant']['guttagonol'])
+        resist_gri.append(snapshot['resistant']['grimpex'])
+        resist_all.append(snapshot['resistant']['all'])
+    pl.plot(y_pop, label='Total virus population')
+    pl.plot(resist_gut, label='guttagonol-resistant')
+    pl.plot(resist_gri, label='grimpex-resistant')
+    pl.plot(resist_all, label='all-resistant')
+    pl.xlabel('Total virus populations')
+    pl.ylabel('Number of patients')
+    pl.legend()
+    pl.show()
+
+#problem7()
+
+EXPERIMENTS = {
+    'problem2': dict(kind='trajectory', arms=[{}], stepsAfter=300),
+    'problem4': dict(kind='trajectory', arms=[{'guttagonol': 150}], stepsAfter=150),
+    'problem5': dict(kind='cohort', arms=[{'guttagonol': delay} for delay in (300, 150, 75, 0)],
+                     numPatients=200, stepsAfter=150),
+    'problem6': dict(kind='cohort', arms=[{'guttagonol': 150, 'grimpex': 150 + lag} for lag in (300, 150, 75, 0)],
+                     numPatients=30, stepsAfter=150),
+    'problem7': dict(kind='trajectory', arms=[{'guttagonol': 150, 'grimpex': 450},
+                                              {'guttagonol': 150, 'grimpex': 150}], stepsAfter=150),
+    'trajectory': dict(kind='trajectory', arms=[{}]),
+    'cohort': dict(kind='cohort', arms=[{}]),
+    'cureRate': dict(kind='cureRate', arms=[{}], numPatients=10000),
+}
+
+ENGINES = {
+    'binomial': BinomialEngine,
+    'gillespie': GillespieEngine,
+    'tauleap': TauLeapEngine,
+    'auto': AutoEngine,
+    'hybrid': HybridEngine,
+}
+
+
+def simulateTrajectory(numSteps, prescriptions, rng=None, maxBirthProb=0.1, clearProb=0.05,
+                       mutProb=0.005, numViruses=100, maxPop=1000, resistances=None, engine=None):
+    """
+    Runs a single CountPatient like simulatePatient, recording the populations
+    after every update.
+    returns: a dictionary with the total population after each update
+    ('total', a list) and the population resistant to each tracked drug and
+    to all of them ('resistant', a dictionary of lists keyed by drug name and
+    'all')
+    """
+    if resistances is None:
+        resistances = dict((drug, False) for drug in Schedule.of(prescriptions).drugs())
+    patient = CountPatient(maxBirthProb, clearProb, resistances, mutProb, numViruses, maxPop, rng, engine)
+    total = []
+    resistant = dict((name, []) for name in patient.drugs + ['all'])
+    for snapshot in iterateSimulation(patient, numSteps, prescriptions):
+        total.append(snapshot['total'])
+        for name, pop in snapshot['resistant'].items():
+            resistant[name].append(pop)
+    return {'total': total, 'resistant': resistant}
+
+
+def iterateSimulation(patient, numSteps=None, prescriptions=None, drugs=None):
+    """
+    Advances a patient one update at a time, yielding its populations after
+    every update so that long runs can be monitored and consumed lazily
+    instead of being kept in memory.
+    patient: a SimplePatient, Patient, CountPatient or Cohort (the values are
+    then arrays with one entry per patient)
+    numSteps: the number of updates (runs until the consumer stops if None)
+    prescriptions: a Schedule, or a dictionary mapping a drug name to the
+    update index after which it is added
+    drugs: the drugs whose resistant populations are reported (defaults to
+    the tracked drugs of a CountPatient, else to the prescribed drugs)
+    returns: a generator of dictionaries with the update index ('step'), the
+    total population ('total') and the population resistant to each drug
+    and to all of them ('resistant', keyed by drug name and 'all'; empty for
+    a SimplePatient)
+    """
+    schedule = Schedule.of(prescriptions)
+    if drugs is None:
+        drugs = getattr(patient, 'drugs', None)
+    if drugs is None:
+        drugs = []
+        for step in schedule.steps():
+            for action, drug in schedule.events[step]:
+                if drug not in drugs:
+                    drugs.append(drug)
+    series = {}
+    if hasattr(patient, 'getResistPop'):
+        series = dict((drug, [drug]) for drug in drugs)
+        series['all'] = list(drugs)
+    m = 0
+    while numSteps is None or m < numSteps:
+        total = patient.update()
+        resistant = dict((name, patient.getResistPop(drugResist)) for name, drugResist in series.items())
+        schedule.apply(patient, m)
+        yield {'step': m, 'total': total, 'resistant': resistant}
+        m += 1
+
+
+class LivePlot(object):
+    """
+    Plots the snapshots of iterateSimulation while they are produced (the
+    mean over patients for a Cohort). The figure is redrawn at most once per
+    interval seconds, and less often if drawing would take more than the
+    overhead fraction of the run time. The history is decimated to at most maxPoints per
+    curve: once full, every other point is dropped and only every
+    stride-th later update is kept, so memory and drawing costs stay bounded
+    however long the run.
+    """
+    def __init__(self, interval=0.5, maxPoints=2000, overhead=0.05, title="Virus population"):
+        """
+        interval: the shortest time between redraws in seconds (a float)
+        overhead: the largest fraction of the time spent drawing (a float)
+        maxPoints: the largest number of points kept per curve (an integer)
+        title: the title of the figure (a string)
+        """
+        self.interval = interval
+        self.maxPoints = maxPoints
+        self.overhead = overhead
+        self.title = title
+        self.stride = 1
+        self.steps = []
+        self.series = {}
+        self.lines = {}
+        self.axes = None
+        self.nextDraw = 0.0
+
+    def watch(self, snapshots):
+        """
+        Passes the snapshots through unchanged while plotting them.
+        returns: a generator of the snapshots
+        """
+        for snapshot in snapshots:
+            self.add(snapshot)
+            yield snapshot
+        self.draw()
+
+    def add(self, snapshot):
+        """
+        Records one snapshot and redraws if the last redraw is old enough.
+        """
+        if snapshot['step'] % self.stride == 0:
+            self.steps.append(snapshot['step'])
+            values = dict(snapshot['resistant'], total=snapshot['total'])
+            for name, value in values.items():
+                self.series.setdefault(name, []).append(float(numpy.mean(value)))
+            if len(self.steps) > self.maxPoints:
+                self.steps = self.steps[::2]
+                for name in self.series:
+                    self.series[name] = self.series[name][::2]
+                self.stride *= 2
+        if time.perf_counter() >= self.nextDraw:
+            self.draw()
+
+    def draw(self):
+        """
+        Redraws the figure with the recorded history.
+        """
+        start = time.perf_counter()
+        pylab = _pylab()
+        if self.axes is None:
+            pylab.ion()
+            self.axes = pylab.figure().gca()
+            self.axes.set_title(self.title)
+            self.axes.set_xlabel("Time Steps")
+            self.axes.set_ylabel("Average Virus Population")
+        for name, values in self.series.items():
+            if name not in self.lines:
+                label = "Total" if name == 'total' else "Resistant to all" if name == 'all' else name + "-resistant"
+                self.lines[name] = self.axes.plot([], [], label=label)[0]
+                self.axes.legend(loc='best')
+            self.lines[name].set_data(self.steps, values)
+        self.axes.relim()
+        self.axes.autoscale_view()
+        pylab.pause(0.001)
+        end = time.perf_counter()
+        self.nextDraw = end + max(self.interval, (end - start) / self.overhead)
+
+
+_MODEL_VERSION = None
+
+
+def _modelVersion():
+    """
+    returns: a hash of the source of this module, which changes whenever the
+    model code does (a string)
+    """
+    global _MODEL_VERSION
+    if _MODEL_VERSION is None:
+        with open(__file__, 'rb') as f:
+            _MODEL_VERSION = hashlib.sha256(f.read()).hexdigest()[:16]
+    return _MODEL_VERSION
+
+
+class ResultCache(object):
+    """
+    Stores the results of runExperiment in a directory, one json file per
+    run, keyed by the model version and every parameter of the run (seed,
+    engine and prescription schedules included). The least recently used
+    entries are removed once the files exceed maxBytes, and entries of other
+    model versions are removed as soon as a new result is stored.
+    """
+    def __init__(self, directory, maxBytes=256 * 2 ** 20):
+        """
+        directory: the directory holding the entries (created if missing)
+        maxBytes: the largest total size of the entries (an integer)
+        """
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.version = _modelVersion()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, parameters):
+        key = hashlib.sha256(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:32]
+        return os.path.join(self.directory, self.version + '-' + key + '.json')
+
+    def get(self, parameters):
+        """
+        returns: the stored result of the run with these parameters (a
+        dictionary), or None if there is none
+        """
+        path = self._path(parameters)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry['parameters'] != json.loads(json.dumps(parameters)):
+            return None
+        os.utime(path)
+        return entry['result']
+
+    def put(self, parameters, result):
+        """
+        Stores the result of the run with these parameters, then evicts old
+        entries.
+        """
+        path = self._path(parameters)
+        temp = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump({'model': self.version, 'parameters': parameters, 'result': result}, f)
+        os.replace(temp, path)
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the entries of other model versions, then the least recently
+        used entries until the rest fit in maxBytes.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if not name.endswith('.json'):
+                    continue
+                if not name.startswith(self.version + '-'):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = 0
+        for mtime, size, path in sorted(entries, reverse=True):
+            total += size
+            if total > self.maxBytes:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def runExperiment(kind, arms, numPatients=100, stepsAfter=150, seed=None, workers=None, maxBirthProb=0.1,
+                  clearProb=0.05, mutProb=0.005, numViruses=100, maxPop=1000, drugs=None, cureThreshold=50,
+                  engine='binomial', targetWidth=0.05, confidence=0.95, batchSize=100, commonRandomNumbers=False,
+                  histogramBins=20, summarize=False, shard=None, cache=None):
+    """
+    Runs an experiment with the count-based engines and returns its results
+    instead of plotting them.
+    kind: 'trajectory' (one patient per arm, populations after every update),
+    'cohort' (numPatients patients per arm, final populations only) or
+    'cureRate' (patients added in batches of batchSize until the confidence
+    interval of each arm's cure rate is narrower than targetWidth or clear of
+    the other arms, at most numPatients per arm; see estimateCureRates)
+    Cohort arms always start from the same patients (see simulateArms), so
+    their results include pairedDifferences; cureRate arms do with
+    commonRandomNumbers.
+    arms: a list of prescription schedules, one per arm, each a Schedule
+    (which can also stop drugs) or a dictionary mapping a drug name to the
+    update index after which it is added. Every arm runs stepsAfter updates
+    past its last event.
+    seed: the master seed; if None, cohorts are advanced as one vectorized
+    Cohort (binomial engine only; other engines get a fresh seed) and
+    trajectories use fresh generators
+    workers: the number of worker processes for seeded cohorts
+    drugs: the drugs whose resistance is tracked (defaults to every drug in arms)
+    cureThreshold: the largest final population counted as cured
+    engine: the name of the stepping engine (a key of ENGINES)
+    commonRandomNumbers: draw patient i of every arm of a seeded experiment
+    from the same patientStreams
+    histogramBins: the number of bins of the final population histograms of
+    cohorts, which span 0 to maxPop
+    summarize: report each arm of a cohort as a PopulationSummary (histogram,
+    cured fraction, mean, variance and quantiles, plus its mergeable state
+    in 'summary') computed by the workers, without keeping the final
+    population of every patient or pairedDifferences
+    shard: only simulate the patients [start, stop) of a seeded cohort (a
+    pair of integers with 0 <= start < stop <= numPatients; other kinds
+    cannot be sharded and raise ValueError); the result then holds their
+    final populations ('finalPops', one list per arm) and the shard, for
+    mergeShards()
+    cache: a ResultCache; runs with a given seed are looked up in it before
+    simulating and stored in it afterwards (unseeded runs are never cached)
+    returns: a dictionary of the parameters and the results of each arm,
+    suitable for json
+    """
+    schedules = [Schedule.of(arm) for arm in arms]
+    if drugs is None:
+        drugs = []
+        for schedule in schedules:
+            for drug in schedule.drugs():
+                if drug not in drugs:
+                    drugs.append(drug)
+    resistances = dict((drug, False) for drug in drugs)
+    seeded = seed is not None
+    if shard is not None:
+        if kind != 'cohort':
+            raise ValueError("only cohort experiments can be sharded, not " + str(kind))
+        if not seeded:
+            raise ValueError("a shard of a cohort needs a master seed")
+        if not 0 <= shard[0] < shard[1] <= numPatients:
+            raise ValueError("a shard [start, stop) needs 0 <= start < stop <= numPatients (%d), got [%d, %d)" %
+                             (numPatients, shard[0], shard[1]))
+    if seed is None and (kind == 'cohort' and engine != 'binomial' or kind == 'cureRate'):
+        seed = numpy.random.SeedSequence().entropy
+    parameters = dict(kind=kind, arms=[arm.toList() if isinstance(arm, Schedule) else arm for arm in arms],
+                      numPatients=numPatients, stepsAfter=stepsAfter, seed=seed,
+                      maxBirthProb=maxBirthProb, clearProb=clearProb, mutProb=mutProb,
+                      numViruses=numViruses, maxPop=maxPop, drugs=drugs, cureThreshold=cureThreshold,
+                      engine=engine, commonRandomNumbers=commonRandomNumbers)
+    if kind == 'cohort':
+        parameters.update(histogramBins=histogramBins, summarize=summarize)
+    if kind == 'cureRate':
+        parameters.update(targetWidth=targetWidth, confidence=confidence, batchSize=batchSize)
+    armParams = [dict(numSteps=max(schedule.steps() + [0]) + stepsAfter, prescriptions=schedule,
+                      maxBirthProb=maxBirthProb, clearProb=clearProb, mutProb=mutProb,
+                      numViruses=numViruses, maxPop=maxPop, resistances=resistances)
+                 for schedule in schedules]
+    key = dict(parameters, shard=None if shard is None else list(shard))
+    if cache is not None and seeded:
+        experiment = cache.get(key)
+        if experiment is not None:
+            return experiment
+    results = []
+    if kind == 'trajectory':
+        for armIndex, params in enumerate(armParams):
+            rng = None if seed is None else patientRng(seed, 0, armIndex)
+            results.append(simulateTrajectory(rng=rng, engine=ENGINES[engine](), **params))
+        experiment = {'parameters': parameters, 'results': results}
+    elif kind == 'cohort' and summarize:
+        summary = PopulationSummary(maxPop, histogramBins, cureThreshold)
+        if seed is None:
+            cohort = Cohort(maxBirthProb, clearProb, resistances, mutProb, numViruses, maxPop, numPatients)
+            summaries = [copy.deepcopy(summary).add(pops) for pops in simulateArms(cohort, armParams)]
+        else:
+            start, stop = (0, numPatients) if shard is None else shard
+            summaries = summarizeCohortParallel([dict(params, engine=ENGINES[engine]()) for params in armParams],
+                                                stop - start, seed, summary, workers, sharePrefix=True,
+                                                commonRandomNumbers=commonRandomNumbers, firstPatient=start)
+        if shard is None:
+            experiment = _summaryExperiment(parameters, summaries)
+        else:
+            experiment = {'parameters': parameters, 'shard': list(shard),
+                          'summaries': [summary.toDict() for summary in summaries]}
+    elif kind == 'cohort' and shard is not None:
+        final_pops = runCohortParallel([dict(params, engine=ENGINES[engine]()) for params in armParams],
+                                       shard[1] - shard[0], seed, workers, sharePrefix=True,
+                                       commonRandomNumbers=commonRandomNumbers, firstPatient=shard[0])
+        experiment = {'parameters': parameters, 'shard': list(shard),
+                      'finalPops': [pops.tolist() for pops in final_pops]}
+    elif kind == 'cohort':
+        if seed is None:
+            cohort = Cohort(maxBirthProb, clearProb, resistances, mutProb, numViruses, maxPop, numPatients)
+            final_pops = simulateArms(cohort, armParams)
+        else:
+            final_pops = runCohortParallel([dict(params, engine=ENGINES[engine]()) for params in armParams],
+                                           numPatients, seed, workers, sharePrefix=True,
+                                           commonRandomNumbers=commonRandomNumbers)
+        experiment = _cohortExperiment(parameters, final_pops)
+    elif kind == 'cureRate':
+        results = estimateCureRates([dict(params, engine=ENGINES[engine]()) for params in armParams], seed,
+                                    targetWidth, confidence, batchSize, numPatients, cureThreshold, workers,
+                                    commonRandomNumbers=commonRandomNumbers)
+        experiment = {'parameters': parameters, 'results': results}
+        if commonRandomNumbers:
+            experiment['pairedDifferences'] = pairedDifferences([result['finalPops'] for result in results],
+                                                                cureThreshold, confidence)
+    else:
+        raise ValueError("unknown experiment kind: " + str(kind))
+    if cache is not None and seeded:
+        cache.put(key, experiment)
+    return experiment
+
+
+def _cohortExperiment(parameters, final_pops):
+    """
+    Builds the result of a cohort experiment from the final populations of
+    each arm (numpy arrays), see runExperiment.
+    """
+    results = []
+    edges = numpy.linspace(0, parameters['maxPop'], parameters['histogramBins'] + 1)
+    for y_pop_total in final_pops:
+        counts = numpy.histogram(numpy.minimum(y_pop_total, parameters['maxPop']), edges)[0]
+        results.append({'finalPops': y_pop_total.tolist(),
+                        'curedFraction': float((y_pop_total <= parameters['cureThreshold']).mean()),
+                        'histogram': {'edges': edges.tolist(), 'counts': counts.tolist()}})
+    experiment = {'parameters': parameters, 'results': results}
+    experiment['pairedDifferences'] = pairedDifferences(final_pops, parameters['cureThreshold'])
+    return experiment
+
+
+def _summaryExperiment(parameters, summaries):
+    """
+    Builds the result of a summarized cohort experiment from the
+    PopulationSummary of each arm, see runExperiment.
+    """
+    return {'parameters': parameters,
+            'results': [dict(summary.report(), summary=summary.toDict()) for summary in summaries]}
+
+
+def writeShard(shard, path):
+    """
+    Writes the result of runExperiment(shard=...) to a compact .npz file.
+    """
+    arrays = dict(shard=numpy.array(shard['shard']), parameters=json.dumps(shard['parameters']))
+    if 'summaries' in shard:
+        arrays['summaries'] = json.dumps(shard['summaries'])
+    else:
+        arrays['finalPops'] = numpy.array(shard['finalPops'], dtype=numpy.int64)
+    numpy.savez_compressed(path, **arrays)
+
+
+def readShard(path):
+    """
+    returns: the shard written by writeShard() to path (a dictionary)
+    """
+    with numpy.load(path) as data:
+        shard = {'parameters': json.loads(str(data['parameters'])), 'shard': data['shard'].tolist()}
+        if 'summaries' in data.files:
+            shard['summaries'] = json.loads(str(data['summaries']))
+        else:
+            shard['finalPops'] = data['finalPops']
+        return shard
+
+
+def mergeShards(shards):
+    """
+    Combines shards of one cohort experiment, run by runExperiment(shard=...)
+    possibly on different machines, into the result the whole cohort would
+    have given in a single run. The shards must come from the same
+    parameters and seed and cover every patient exactly once.
+    shards: a list of shards, in any order
+    returns: the experiment dictionary, as returned by runExperiment
+    """
+    parameters = shards[0]['parameters']
+    for shard in shards:
+        if shard['parameters'] != parameters:
+            raise ValueError("shards of different experiments cannot be merged")
+    shards = sorted(shards, key=lambda shard: shard['shard'][0])
+    expected = 0
+    for shard in shards:
+        if shard['shard'][0] != expected:
+            raise ValueError("shards do not cover patient " + str(expected) + " exactly once")
+        expected = shard['shard'][1]
+    if expected != parameters['numPatients']:
+        raise ValueError("shards stop at patient " + str(expected) + " of " + str(parameters['numPatients']))
+    if parameters.get('summarize'):
+        summaries = [PopulationSummary.fromDict(state) for state in shards[0]['summaries']]
+        for shard in shards[1:]:
+            for summary, state in zip(summaries, shard['summaries']):
+                summary.merge(PopulationSummary.fromDict(state))
+        return _summaryExperiment(parameters, summaries)
+    final_pops = [numpy.concatenate([numpy.asarray(shard['finalPops'][armIndex], dtype=numpy.int64)
+                                     for shard in shards])
+                  for armIndex in range(len(parameters['arms']))]
+    return _cohortExperiment(parameters, final_pops)
+
+
+def plotExperiment(experiment, path):
+    """
+    Draws the results of runExperiment, one panel per arm, and saves the
+    figure to a file instead of showing it.
+    experiment: the dictionary returned by runExperiment
+    path: the image file to write (a string)
+    """
+    pl = _pylab(headless=True)
+    parameters = experiment['parameters']
+    results = experiment['results']
+    pl.figure(figsize=(8, 3 * len(results)))
+    for armIndex, (arm, result) in enumerate(zip(parameters['arms'], results)):
+        pl.subplot(len(results), 1, armIndex + 1)
+        if parameters['kind'] == 'trajectory':
+            pl.plot(result['total'], label='Total virus population')
+            for name, pops in result['resistant'].items():
+                pl.plot(pops, label=name + '-resistant')
+            pl.xlabel('time step')
+            pl.ylabel('virus population')
+            pl.legend()
+            pl.title(str(arm))
+        else:
+            if 'finalPops' in result:
+                pl.hist(result['finalPops'])
+            else:
+                pl.stairs(result['histogram']['counts'], result['histogram']['edges'], fill=True)
+            pl.xlabel('Total virus populations')
+            pl.ylabel('Number of patients')
+            title = str(arm) + ": " + str(result['curedFraction'] * 100) + "% of patients were cured"
+            if 'interval' in result:
+                title += " (%.1f-%.1f%%, %d patients)" % (result['interval'][0] * 100, result['interval'][1] * 100,
+                                                          result['patients'])
+            pl.title(title)
+    pl.tight_layout()
+    pl.savefig(path)
+    pl.close()
+
+
+def compareModels(numPatients=200, numSteps=300, prescriptions=None, seed=0, maxBirthProb=0.1, clearProb=0.05,
+                  mutProb=0.005, numViruses=100, maxPop=1000, resistances=None, engine=None):
+    """
+    Checks that the particle model (Patient) and a count engine give the same
+    distribution of final populations: numPatients patients of each are run
+    through the same schedule and the two samples are compared with a
+    two-sample Kolmogorov-Smirnov test.
+    prescriptions: a Schedule or a dictionary mapping each drug name to the
+    update index after which it is added (defaults to no drugs)
+    engine: the stepping engine of the count patients (defaults to
+    BinomialEngine)
+    returns: a dictionary with the mean final population ('particleMean',
+    'countMean') and cured fraction at the default threshold of 50
+    ('particleCured', 'countCured') of each model, the KS statistic
+    ('statistic') and its asymptotic p-value ('pValue')
+    """
+    schedule = Schedule.of(prescriptions)
+    if resistances is None:
+        resistances = dict((drug, False) for drug in schedule.drugs())
+    random.seed(seed)
+    particle = []
+    for i in range(numPatients):
+        viruses = [ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)] * numViruses
+        particle.append(schedule.run(Patient(viruses, maxPop), numSteps))
+    count = [schedule.run(CountPatient(maxBirthProb, clearProb, resistances, mutProb, numViruses, maxPop,
+                                       patientRng(seed, i), engine), numSteps)
+             for i in range(numPatients)]
+    a = numpy.sort(particle)
+    b = numpy.sort(count)
+    values = numpy.concatenate([a, b])
+    statistic = float(numpy.max(numpy.abs(numpy.searchsorted(a, values, 'right') / len(a) -
+                                          numpy.searchsorted(b, values, 'right') / len(b))))
+    en = math.sqrt(len(a) * len(b) / (len(a) + len(b)))
+    scale = (en + 0.12 + 0.11 / en) * statistic
+    if scale < 0.3:
+        pValue = 1.0
+    else:
+        pValue = 2 * sum((-1) ** (k - 1) * math.exp(-2 * k * k * scale * scale) for k in range(1, 101))
+        pValue = min(max(pValue, 0.0), 1.0)
+    return dict(particleMean=float(a.mean()), countMean=float(b.mean()),
+                particleCured=float(numpy.mean(a <= 50)), countCured=float(numpy.mean(b <= 50)),
+                statistic=statistic, pValue=pValue)
+
+
+BENCHMARK_GRID = {
+    'maxPop': [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7],
+    'numDrugs': [1, 2, 4, 8, 16],
+    'mutProb': [0.005, 0, 0.05],
+    'numPatients': [1, 100, 10000],
+}
+
+BENCHMARK_CASES = ['SimplePatient.update', 'Patient.update', 'Patient.getResistPop',
+                   'CountPatient.update', 'CountPatient.getResistPop', 'TauLeapEngine', 'GillespieEngine',
+                   'HybridEngine', 'AutoEngine', 'Cohort.update']
+
+
+def _benchmarkSubject(case, maxPop, numDrugs, mutProb, numPatients, seed):
+    """
+    Builds the object timed by one benchmark case, with a population at half
+    of maxPop and no drug administered, and the function performing one
+    timed operation on it.
+    """
+    resistances = dict(('drug' + str(i), False) for i in range(numDrugs))
+    drugResist = list(resistances)
+    rng = numpy.random.default_rng(seed)
+    numViruses = maxPop // 2
+    if case == 'SimplePatient.update':
+        subject = SimplePatient([SimpleVirus(0.1, 0.05)] * numViruses, maxPop)
+        return subject, subject.update
+    if case.startswith('Patient.'):
+        subject = Patient([ResistantVirus(0.1, 0.05, resistances, mutProb)] * numViruses, maxPop)
+        if case == 'Patient.update':
+            return subject, subject.update
+        return subject, lambda: subject.getResistPop(drugResist)
+    if case == 'Cohort.update':
+        subject = Cohort(0.1, 0.05, resistances, mutProb, numViruses, maxPop, numPatients, rng)
+        return subject, subject.update
+    engine = {'TauLeapEngine': TauLeapEngine, 'GillespieEngine': GillespieEngine, 'HybridEngine': HybridEngine,
+              'AutoEngine': AutoEngine}.get(case, BinomialEngine)()
+    subject = CountPatient(0.1, 0.05, resistances, mutProb, numViruses, maxPop, rng, engine)
+    if case == 'CountPatient.getResistPop':
+        return subject, lambda: subject.getResistPop(drugResist)
+    return subject, subject.update
+
+
+def benchmarkCases(grid=None, cases=None, objectMaxPop=10 ** 5, maxCells=10 ** 8):
+    """
+    Lists the benchmark cases of a parameter grid, leaving out those that
+    would not finish in reasonable time or memory: particle-based patients and
+    Gillespie steps above objectMaxPop, and cohorts of more than maxCells
+    patient x genotype counts. numPatients only varies for Cohort.update,
+    numDrugs is fixed to 0 for SimplePatient.update, and the cases that draw
+    no offspring (SimplePatient.update and getResistPop) only use the first
+    mutProb.
+    grid: a dictionary like BENCHMARK_GRID (missing keys use its values)
+    cases: the names of the timed operations (defaults to BENCHMARK_CASES)
+    returns: a list of dictionaries with keys case, maxPop, numDrugs, mutProb
+    and numPatients
+    """
+    grid = dict(BENCHMARK_GRID, **(grid or {}))
+    selected = []
+    for case in cases or BENCHMARK_CASES:
+        for maxPop in grid['maxPop']:
+            if maxPop > objectMaxPop and (case.split('.')[0] in ('SimplePatient', 'Patient') or case == 'GillespieEngine'):
+                continue
+            for numDrugs in ([0] if case == 'SimplePatient.update' else grid['numDrugs']):
+                mutating = case != 'SimplePatient.update' and not case.endswith('getResistPop')
+                for mutProb in (grid['mutProb'] if mutating else grid['mutProb'][:1]):
+                    for numPatients in (grid['numPatients'] if case == 'Cohort.update' else [1]):
+                        if numPatients * 2 ** numDrugs > maxCells:
+                            continue
+                        selected.append(dict(case=case, maxPop=maxPop, numDrugs=numDrugs, mutProb=mutProb,
+                                             numPatients=numPatients))
+    return selected
+
+
+def timeBenchmark(case, maxPop, numDrugs, mutProb, numPatients=1, minTime=0.2, maxSteps=1000, seed=0):
+    """
+    Times one benchmark case: repeats its operation until minTime seconds or
+    maxSteps repetitions have passed, then measures the peak memory allocated
+    while building the subject and performing the operation once
+    (tracemalloc, which sees numpy buffers as well as Python objects).
+    returns: a dictionary of the case parameters with stepsPerSec, steps
+    and peakBytes
+    """
+    subject, operation = _benchmarkSubject(case, maxPop, numDrugs, mutProb, numPatients, seed)
+    steps = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while steps < maxSteps and (steps == 0 or elapsed < minTime):
+        operation()
+        steps += 1
+        elapsed = time.perf_counter() - start
+    del subject, operation
+    tracemalloc.start()
+    try:
+        subject, operation = _benchmarkSubject(case, maxPop, numDrugs, mutProb, numPatients, seed)
+        operation()
+        peakBytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return dict(case=case, maxPop=maxPop, numDrugs=numDrugs, mutProb=mutProb, numPatients=numPatients,
+                stepsPerSec=steps / elapsed, steps=steps, peakBytes=peakBytes)
+
+
+def runBenchmarks(grid=None, cases=None, minTime=0.2, report=None, **limits):
+    """
+    Times every case of benchmarkCases(grid, cases, **limits).
+    report: a function called with each result as it is measured (e.g. print)
+    returns: a dictionary with the environment ('machine') and the list of
+    results ('results'), suitable for json
+    """
+    results = []
+    for params in benchmarkCases(grid, cases, **limits):
+        result = timeBenchmark(minTime=minTime, **params)
+        results.append(result)
+        if report is not None:
+            report(result)
+    machine = dict(python=platform.python_version(), numpy=numpy.__version__, platform=platform.platform(),
+                   processor=platform.processor(), time=time.strftime('%Y-%m-%d %H:%M:%S'))
+    return {'machine': machine, 'results': results}
+
+
+def compareBenchmarks(current, baseline, tolerance=0.2):
+    """
+    Compares two runBenchmarks outputs case by case.
+    tolerance: the relative slowdown (a float) above which a case counts as
+    a regression
+    returns: a list of (result, baseline result, ratio of steps/sec) for the
+    regressed cases present in both
+    """
+    def key(result):
+        return (result['case'], result['maxPop'], result['numDrugs'], result['mutProb'], result['numPatients'])
+    previous = dict((key(result), result) for result in baseline['results'])
+    regressions = []
+    for result in current['results']:
+        old = previous.get(key(result))
+        if old is not None:
+            ratio = result['stepsPerSec'] / old['stepsPerSec']
+            if ratio < 1 - tolerance:
+                regressions.append((result, old, ratio))
+    return regressions
+
+
+def _formatBenchmark(result):
+    """
+    returns: one line describing a timeBenchmark result (a string)
+    """
+    return ("%-26s maxPop=%-9d drugs=%-3d mutProb=%-6g patients=%-6d %12.1f steps/sec %10.1f MiB" %
+            (result['case'], result['maxPop'], result['numDrugs'], result['mutProb'], result['numPatients'],
+             result['stepsPerSec'], result['peakBytes'] / 2 ** 20))
+
+
+def _parseArm(text):
+    """
+    Parses a prescription schedule given on the command line, e.g.
+    'guttagonol@150,grimpex@300', or 'none' for no drugs. A drug prefixed
+    with '-' is stopped, e.g. 'guttagonol@150,-guttagonol@300'; such
+    schedules are returned as a Schedule, the others as a dictionary.
+    """
+    arm = {}
+    schedule = Schedule()
+    if text != 'none':
+        for item in text.split(','):
+            drug, step = item.split('@')
+            if drug.startswith('-'):
+                schedule.remove(drug[1:], int(step))
+            else:
+                schedule.add(drug, int(step))
+                arm[drug] = int(step)
+    return arm if len(schedule.toList()) == len(arm) else schedule
+
+
+def _addExperimentArguments(parser):
+    """
+    Adds the experiment name and the parameter overrides of runExperiment to
+    a command-line parser.
+    """
+    parser.add_argument('experiment', choices=sorted(EXPERIMENTS))
+    parser.add_argument('--kind', choices=['trajectory', 'cohort', 'cureRate'],
+                        help="override the kind of the experiment, e.g. cureRate for a sequential estimate")
+    parser.add_argument('--maxPop', type=int)
+    parser.add_argument('--maxBirthProb', type=float)
+    parser.add_argument('--clearProb', type=float)
+    parser.add_argument('--mutProb', type=float)
+    parser.add_argument('--numViruses', type=int)
+    parser.add_argument('--drugs', nargs='*', help="drugs whose resistance is tracked")
+    parser.add_argument('--arm', dest='arms', action='append', type=_parseArm,
+                        help="prescription schedule of one arm, e.g. guttagonol@150,grimpex@300, "
+                             "guttagonol@150,-guttagonol@300 to stop a drug, or none (repeat for several arms)")
+    parser.add_argument('--stepsAfter', type=int, help="updates run after the last prescription")
+    parser.add_argument('--patients', dest='numPatients', type=int, help="cohort size per arm")
+    parser.add_argument('--cureThreshold', type=int)
+    parser.add_argument('--histogramBins', type=int)
+    parser.add_argument('--summarize', action='store_true', default=None,
+                        help="cohort: report constant-memory summaries instead of every final population")
+    parser.add_argument('--targetWidth', type=float, help="cureRate: confidence interval width to reach")
+    parser.add_argument('--confidence', type=float, help="cureRate: confidence level")
+    parser.add_argument('--batchSize', type=int, help="cureRate: patients added per arm at a time")
+    parser.add_argument('--engine', choices=sorted(ENGINES))
+    parser.add_argument('--crn', dest='commonRandomNumbers', action='store_true', default=None,
+                        help="give patient i of every arm the same random streams")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--cache', help="directory caching the results of seeded runs")
+    parser.add_argument('--cacheSize', type=float, default=256,
+                        help="largest size of the cache in megabytes")
+
+
+def _experimentSettings(args):
+    """
+    returns: the runExperiment keyword arguments of parsed command-line
+    arguments (a dictionary)
+    """
+    settings = dict(EXPERIMENTS[args.experiment])
+    for name, value in vars(args).items():
+        if name not in ('command', 'experiment', 'out', 'plot', 'start', 'stop', 'cache', 'cacheSize') \
+                and value is not None:
+            settings[name] = value
+    if args.cache:
+        settings['cache'] = ResultCache(args.cache, int(args.cacheSize * 2 ** 20))
+    return settings
+
+
+def main(argv=None):
+    """
+    Command-line entry point. 'run' runs a named experiment and writes its
+    results to a json file (and optionally a figure) without opening plot
+    windows; 'shard' runs a range of the patients of a seeded cohort and
+    'merge' combines shard files into the result of the whole cohort;
+    'bench' times the update engines and compares with a baseline; 'check'
+    tests that the particle and count models agree.
+    """
+    parser = argparse.ArgumentParser(description="Simulate virus population dynamics.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="run an experiment")
+    _addExperimentArguments(run)
+    run.add_argument('--out', default='results.json', help="json file receiving the results")
+    run.add_argument('--plot', help="image file receiving a figure of the results")
+
+    shard = commands.add_parser('shard', help="run the patients [start, stop) of a seeded cohort experiment")
+    _addExperimentArguments(shard)
+    shard.add_argument('--start', type=int, required=True, help="first patient of the shard")
+    shard.add_argument('--stop', type=int, required=True, help="patient after the last one of the shard")
+    shard.add_argument('--out', default='shard.npz', help="npz file receiving the shard")
+
+    merge = commands.add_parser('merge', help="combine shard files into the result of the whole cohort")
+    merge.add_argument('shards', nargs='+', help="npz files written by shard")
+    merge.add_argument('--out', default='results.json', help="json file receiving the results")
+    merge.add_argument('--plot', help="image file receiving a figure of the results")
+
+    bench = commands.add_parser('bench', help="time the update engines")
+    bench.add_argument('--case', dest='cases', nargs='*', choices=BENCHMARK_CASES)
+    bench.add_argument('--maxPop', nargs='*', type=int)
+    bench.add_argument('--numDrugs', nargs='*', type=int)
+    bench.add_argument('--mutProb', nargs='*', type=float)
+    bench.add_argument('--patients', dest='numPatients', nargs='*', type=int)
+    bench.add_argument('--minTime', type=float, default=0.2, help="seconds spent timing each case")
+    bench.add_argument('--out', default='benchmark.json', help="json file receiving the results")
+    bench.add_argument('--baseline', help="json file of an earlier run to compare with")
+    bench.add_argument('--tolerance', type=float, default=0.2, help="relative slowdown reported as a regression")
+
+    check = commands.add_parser('check', help="test that the particle and count models agree on distribution")
+    check.add_argument('--arm', type=_parseArm, default={}, help="prescription schedule, e.g. guttagonol@150")
+    check.add_argument('--steps', type=int, default=300, help="updates per patient")
+    check.add_argument('--patients', type=int, default=200, help="patients per model")
+    check.add_argument('--engine', choices=sorted(ENGINES))
+    check.add_argument('--seed', type=int, default=0)
+    check.add_argument('--alpha', type=float, default=0.01, help="p-value below which the models disagree")
+    args = parser.parse_args(argv)
+
+    if args.command in ('run', 'merge'):
+        if args.command == 'run':
+            experiment = runExperiment(**_experimentSettings(args))
+        else:
+            experiment = mergeShards([readShard(path) for path in args.shards])
+        with open(args.out, 'w') as f:
+            json.dump(experiment, f)
+        if args.plot:
+            plotExperiment(experiment, args.plot)
+    elif args.command == 'shard':
+        try:
+            shard = runExperiment(shard=(args.start, args.stop), **_experimentSettings(args))
+        except ValueError as error:
+            parser.error(str(error))
+        writeShard(shard, args.out)
+    elif args.command == 'bench':
+        grid = dict((name, getattr(args, name)) for name in BENCHMARK_GRID if getattr(args, name))
+        current = runBenchmarks(grid, args.cases, args.minTime, report=lambda result: print(_formatBenchmark(result)))
+        with open(args.out, 'w') as f:
+            json.dump(current, f, indent=1)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            regressions = compareBenchmarks(current, baseline, args.tolerance)
+            for result, old, ratio in regressions:
+                print("REGRESSION %s: %.0f%% of baseline %.1f steps/sec" %
+                      (_formatBenchmark(result), ratio * 100, old['stepsPerSec']))
+            if regressions:
+                sys.exit(1)
+    elif args.command == 'check':
+        engine = ENGINES[args.engine]() if args.engine else None
+        result = compareModels(args.patients, args.steps, args.arm, args.seed, engine=engine)
+        print("particle mean %.1f cured %.3f, count mean %.1f cured %.3f, KS statistic %.3f, p-value %.3g" %
+              (result['particleMean'], result['particleCured'], result['countMean'], result['countCured'],
+               result['statistic'], result['pValue']))
+        if result['pValue'] < args.alpha:
+            print("DISAGREEMENT between the particle and count models")
+            sys.exit(1)
 
-    #150-150
-    viruses = []
-    for j in range(len_viruses):
-        viruses.append(resistant_virus)
-    single_patient = Patient(viruses, maxPop)
-    y_pop = []
-    resist_gut = []
-    resist_gri = []
-    resist_all = []
-    for m in range(timesteps+timesteps):
-        y_pop.append(single_patient.update())
-        resist_gut.append(single_patient.getResistPop(['guttagonol']))
-        resist_gri.append(single_patient.getResistPop(['grimpex']))
-        resist_all.append(single_patient.getResistPop(['guttagonol', 'grimpex']))
-        if m == timesteps:
-            single_patient.addPrescription("guttagonol")
-            single_patient.addPrescription("grimpex")
-    pl.plot(y_pop, label='Total virus population')
-    pl.plot(resist_gut, label='guttagonol-resistant')
-    pl.plot(resist_gri, label='grimpex-resistant')
-    pl.plot(resist_all, label='all-resistant')
-    pl.xlabel('Total virus populations')
-    pl.ylabel('Number of patients')
-    pl.legend()
-    pl.show()
 
-problem7()
\ No newline at end of file
+if __name__ == '__main__':
+    main()